@@ -0,0 +1,207 @@
+import asyncio
+import io
+import logging
+import sys
+import urllib.parse
+
+from aiohttp import web, WSMsgType
+from multidict import CIMultiDict
+
+from lykan.main import (app, configure, count_frame, encode_frame, make_arg_parser, mobile_client, master_client,
+                        scheduler, CompactEncoder, FrameBatch, Wait, PROFILER)
+
+
+app.config.setdefault("DEFLATE", True)
+
+
+class AsyncConnection:
+    """The asyncio side of a websocket, closed by the reaper."""
+
+    def __init__(self, ws, loop):
+        self.ws = ws
+        self.loop = loop
+        app.connection_stats["open"] += 1
+
+    def close(self, abort=False):
+        self.loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self.ws.close()))
+
+
+async def wait(msg, timeout=None):
+    """Like Wait.block, returns whether the wait is over."""
+    if msg.predicate is None:
+        if timeout is not None and timeout < msg.timeout:
+            return False
+        await asyncio.sleep(msg.timeout)
+        return True
+    try:
+        await asyncio.wait_for(wait_for_change(msg), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+async def wait_for_change(msg):
+    changed = asyncio.Event()
+    msg.game.wakers.add(changed.set)  # Games change on the loop, in the steps of the scheduler.
+    try:
+        while not msg.predicate():
+            await changed.wait()
+            changed.clear()
+    finally:
+        msg.game.wakers.discard(changed.set)
+
+
+async def receive(ws):
+    while True:
+        msg = await ws.receive()
+        if msg.type != WSMsgType.TEXT:
+            return None
+        if msg.data != "__PING":  # Sent by pages loaded before the keepalive used ping frames.
+            count_frame("in", msg.data)
+            return msg.data
+
+
+async def send(ws, msg, encoder):
+    data = encode_frame(msg, encoder)
+    try:
+        await asyncio.wait_for(ws.send_str(data), app.config["SEND_TIMEOUT"])
+    except asyncio.TimeoutError:
+        app.connection_stats["stalled"] += 1
+        app.connection_stats["dropped_frames"] += 1
+        return False
+    count_frame("out", data)
+    return True
+
+
+async def run_client_on_ws(client, ws, app_ctx, batch=None, encoder=None):
+    """Drives a client generator like main.run_client_on_ws. Each step runs within the
+    application context of the connection, as the generators need the locale in `g`."""
+    reply = None
+    while not ws.closed:
+        try:
+            with app_ctx:
+                msg = client.send(reply)
+        except StopIteration:
+            if batch and batch.frames:
+                await send(ws, batch.wrap(), encoder)
+            break
+        reply = None
+        if isinstance(msg, Wait):
+            if batch and batch.frames:
+                if await wait(msg, batch.remaining()):
+                    continue
+                if not await send(ws, batch.wrap(), encoder):
+                    break
+            await wait(msg)
+            continue
+        if batch and batch.take(msg):
+            reply = " "
+            continue
+        if not await send(ws, batch.wrap(msg) if batch else msg, encoder):
+            break
+        reply = await receive(ws)
+        if reply is None:  # WS closed
+            break
+
+
+def make_ws_endpoint(client_func):
+    async def endpoint(request):
+        loop = asyncio.get_running_loop()
+        # permessage-deflate is used when the browser offers it.
+        ws = web.WebSocketResponse(heartbeat=app.config["PING_INTERVAL"], compress=app.config["DEFLATE"])
+        await ws.prepare(request)
+        conn = AsyncConnection(ws, loop)
+        try:
+            code = await asyncio.wait_for(receive(ws), app.config["CODE_TIMEOUT"])
+        except asyncio.TimeoutError:
+            code = None
+        game = app.games.get(code)
+        if game is not None:
+            game.touch()
+            game.connections.add(conn)
+        try:
+            since = request.query.get("since")
+            app_ctx = app.app_context()
+            with app_ctx:
+                client = client_func(game, int(since) if since and since.isdigit() else None)
+            await run_client_on_ws(client, ws, app_ctx, FrameBatch() if request.query.get("batch") else None,
+                                   CompactEncoder(game) if request.query.get("compact") else None)
+        finally:
+            if game is not None:
+                game.connections.discard(conn)
+            app.connection_stats["open"] -= 1
+            if isinstance(ws.exception(), asyncio.TimeoutError):  # No pong for the heartbeat.
+                app.connection_stats["dead_peers"] += 1
+            await ws.close()
+        return ws
+    PROFILER.anchors[endpoint.__code__] = lambda local: local.get("game")
+    return endpoint
+
+
+async def wsgi(request):
+    """Serves everything but the websockets with the Flask app. Its views do not block, so
+    they run right on the event loop."""
+    body = await request.read()
+    environ = {
+        "REQUEST_METHOD": request.method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": urllib.parse.unquote(request.path, "latin-1"),
+        "QUERY_STRING": request.query_string,
+        "SERVER_NAME": request.url.host or "localhost",
+        "SERVER_PORT": str(request.url.port or 80),
+        "SERVER_PROTOCOL": "HTTP/%i.%i" % request.version,
+        "REMOTE_ADDR": request.remote or "",
+        "CONTENT_TYPE": request.headers.get("Content-Type", ""),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": request.scheme,
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in request.headers.items():
+        key = "HTTP_" + name.upper().replace("-", "_")
+        if key not in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+            environ[key] = environ[key] + "," + value if key in environ else value
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    result = app.wsgi_app(environ, start_response)
+    try:
+        data = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    status, headers = started
+    headers = CIMultiDict((name, value) for name, value in headers if name.lower() != "content-length")
+    return web.Response(body=data, status=int(status.split(" ", 1)[0]), headers=headers)
+
+
+def make_app():
+    web_app = web.Application()
+    web_app.router.add_get("/mobilews", make_ws_endpoint(mobile_client))
+    web_app.router.add_get("/masterws", make_ws_endpoint(master_client))
+    web_app.router.add_route("*", "/{path:.*}", wsgi)
+    return web_app
+
+
+def main():
+    parser = make_arg_parser("Runs the Werewolves server on asyncio instead of gevent.")
+    parser.add_argument("--no-deflate", dest="deflate", action="store_false",
+                        help="do not compress websocket messages with permessage-deflate")
+    args = parser.parse_args()
+    app.config.update(DEFLATE=args.deflate)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    scheduler.start(loop)  # The games are stepped on the loop, no thread touches them.
+    configure(args)
+    logging.info("Serving on port %i", args.port)
+    web.run_app(make_app(), port=args.port, print=None, access_log=None, loop=loop)
+
+
+if __name__ == '__main__':
+    main()
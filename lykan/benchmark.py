@@ -0,0 +1,357 @@
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import gevent
+import websocket
+
+from lykan import util
+
+
+GAME_END = "The game has ended"
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+
+def create_game(base_url, seed=None):
+    data = urllib.parse.urlencode({} if seed is None else dict(seed=seed)).encode()
+    try:
+        urllib.request.build_opener(NoRedirect).open(urllib.request.Request(base_url + "/create_new_game/en", data=data))
+    except urllib.error.HTTPError as exc:
+        if exc.code in (301, 302, 303):
+            return exc.headers["Location"].rsplit("/", 1)[1]
+        raise
+    raise RuntimeError("Game creation did not redirect")
+
+
+LONG_KEYS = {short: key for key, short in util.COMPACT_KEYS.items()}
+
+
+def expand(frame, roster):
+    """Decodes a frame of the compact encoding like lykan.js.j2 does."""
+    roster.update((int(seat), name) for seat, name in frame.pop("r", {}).items())
+    msg = {LONG_KEYS.get(key, key): value for key, value in frame.items()}
+    name = lambda id: roster[id] if isinstance(id, int) else id
+    for key in ("players", "joined", "amongst"):
+        if msg.get(key):
+            msg[key] = [name(id) for id in msg[key]]
+    if msg.get("player") is not None:
+        msg["player"] = name(msg["player"])
+    if "vote" in msg:
+        msg["vote"] = {name(voter): name(votee) for voter, votee in msg["vote"]}
+    if "batch" in msg:
+        msg["batch"] = [expand(item, roster) for item in msg["batch"]]
+    return msg
+
+
+def check_compact():
+    """Encodes frames like a game sends them and decodes them again, returns the frames which differ.
+
+    Catches keys added on one side of util.COMPACT_KEYS and lykan.js.j2 but not on the other."""
+    from lykan.main import CompactEncoder, FrameBatch, ScheduledGame, app, encode_frame
+    game = ScheduledGame("en", "CHECK")
+    for name in ("Anna", "Bob", "Carl", "Dora"):
+        game.add_player(name)
+    batch = FrameBatch()
+    with app.app_context():
+        for seq, frame in enumerate([dict(content="Carl died.", players=["Carl"], temporary=False),
+                                     dict(content="Votes.", vote={"Anna": "Bob", "Bob": "Anna", "Dora": "Bob"})]):
+            batch.take(dict(frame, seq=seq))
+    frames = [
+        dict(ask="showplayers", players=["Anna", "Bob"], joined=[], prefetch=["a.mp3"]),
+        dict(ask="showplayers", players=["Anna", "Bob"], joined=["Carl"]),
+        dict(player="Dora", card_title="Seer", available=["Seer"]),
+        batch.wrap(dict(ask="n", n=1, amongst=["Anna", "Bob", "Dora"], prompt="Whom?", seq=2, hash="x")),
+        dict(ask="n", n=2, amongst=["Anna", "Stranger"], prompt="Whom?", seq=3),
+    ]
+    encoder, roster = CompactEncoder(game), {}
+    return [(frame, decoded) for frame, decoded in
+            ((frame, expand(json.loads(encode_frame(frame, encoder)), roster)) for frame in frames) if decoded != frame]
+
+
+class BotClient:
+    """Speaks the WSUI protocol on one websocket and answers every request right away.
+
+    Latencies are taken from each reply to the next message on the same socket once
+    the game runs. Bots never think and the server does not pace, so the game only
+    ever waits for the server."""
+
+    def __init__(self, bench, ws_url, code, name, rng):
+        self.bench = bench
+        self.code = code
+        self.name = name
+        self.rng = rng
+        self.ws = websocket.create_connection(ws_url, timeout=bench.timeout)
+        self.ws.send(code)
+        self.running = False
+        self.replied_at = None
+        self.roster = {}
+
+    def close(self):
+        self.ws.close(timeout=0)  # The server does not answer the closing handshake.
+
+    def reply(self, data):
+        self.ws.send(data)
+        self.replied_at = time.perf_counter() if self.running else None
+
+    def receive(self):
+        """Returns the messages of the next frame, the last one is to be answered unless it is acknowledged."""
+        data = self.ws.recv()
+        if not data:
+            return None
+        if self.replied_at is not None:
+            self.bench.latencies.append(time.perf_counter() - self.replied_at)
+            self.replied_at = None
+        self.bench.bytes += len(data)
+        msg = json.loads(data)
+        if self.bench.compact:
+            msg = expand(msg, self.roster)
+        msgs = msg.get("batch", [msg])
+        self.bench.frames += 1
+        self.bench.messages += len(msgs)
+        return msgs
+
+    def answer(self, msg):
+        ask = msg.get("ask")
+        if ask == "nonce":
+            return self.name + "-nonce"
+        elif ask == "string":
+            return self.name
+        elif ask == "n":
+            return json.dumps(self.rng.sample(msg["amongst"], min(msg["n"], len(msg["amongst"]))))
+        elif ask == "yesno":
+            return self.rng.choice("tn")
+        return " "
+
+
+class PlayerBot(BotClient):
+    def run(self):
+        setups = 0
+        while True:
+            try:
+                msgs = self.receive()
+            except (OSError, websocket.WebSocketException):
+                return  # Dead players may hear nothing until the game ends.
+            if msgs is None:
+                return
+            msg = msgs[-1]
+            if msg.get("ask") == "setup":
+                setups += 1
+                self.running = setups > 1  # The second setup comes with the start of the game.
+            if not msg.get("acked"):
+                self.reply(self.answer(msg))
+
+
+class MasterBot(BotClient):
+    def __init__(self, bench, ws_url, code, name, rng, num_players, card_mix):
+        super().__init__(bench, ws_url, code, name, rng)
+        self.num_players = num_players
+        self.card_mix = card_mix
+
+    def run(self):
+        """Plays until the server closes the connection, returns whether the game ended."""
+        joined = 0
+        ended = False
+        while True:
+            msgs = self.receive()
+            if msgs is None:
+                return ended
+            ended = ended or any((msg.get("content") or "").startswith(GAME_END) for msg in msgs)
+            msg = msgs[-1]
+            ask = msg.get("ask")
+            if ask == "showplayers":
+                joined += len(msg.get("players", [])) + len(msg.get("joined", []))
+                self.reply(" ")
+                if joined == self.num_players:
+                    urllib.request.urlopen("%s/start_game/%s/%s" % (self.bench.base_url, self.code, self.name + "-nonce")).read()
+            elif ask == "cards":
+                self.running = True
+                self.reply(json.dumps(dict(cards=self.card_mix, speed=1)))
+            elif not msg.get("acked"):
+                self.reply(self.answer(msg))
+
+
+class Benchmark:
+    def __init__(self, base_url, num_players, card_mix, timeout, server_pid=None, batch=False, compact=False):
+        self.base_url = base_url
+        self.batch = batch
+        self.compact = compact
+        self.ws_base = "ws" + base_url[len("http"):]
+        self.num_players = num_players
+        self.card_mix = card_mix
+        self.timeout = timeout
+        self.server_pid = server_pid
+        self.latencies = []
+        self.messages = 0
+        self.frames = 0
+        self.bytes = 0
+        self.rss_peak = 0
+
+    def play_game(self, rng):
+        """Plays one game with bots, returns whether it reached its end."""
+        code = create_game(self.base_url, rng.getrandbits(32))  # Seeded, so runs can be compared.
+        query = "?" + "batch=1&" * self.batch + "compact=1&" * self.compact + "code="
+        master = MasterBot(self, self.ws_base + "/masterws" + query + code, code, "master-%s" % code, rng,
+                           self.num_players, self.card_mix)
+        players = []
+        try:
+            players = [PlayerBot(self, self.ws_base + "/mobilews" + query + code, code, "P%i" % i, rng) for i in range(self.num_players)]
+            greenlets = [gevent.spawn(player.run) for player in players]
+            try:
+                ended = master.run()
+                gevent.joinall(greenlets, timeout=self.timeout)  # The winners still hear about it.
+                return ended
+            finally:
+                gevent.killall(greenlets)
+        finally:
+            for client in [master] + players:
+                client.close()
+
+    def run_level(self, concurrency, duration, seed):
+        """Plays games back to back on `concurrency` slots for `duration` seconds."""
+        self.latencies = []
+        self.messages = 0
+        self.frames = 0
+        self.bytes = 0
+        rss_base = self.server_rss()
+        self.rss_peak = rss_base or 0
+        finished, failed = [0], [0]
+        end = time.monotonic() + duration
+
+        def slot(i):
+            rng = random.Random("%s-%i" % (seed, i))
+            while time.monotonic() < end:
+                try:
+                    ok = self.play_game(rng)
+                except (OSError, websocket.WebSocketException) as exc:
+                    print("Game failed: %r" % exc, file=sys.stderr)
+                    ok = False
+                if ok:
+                    finished[0] += 1
+                else:
+                    failed[0] += 1
+
+        start = time.monotonic()
+        slots = [gevent.spawn(slot, i) for i in range(concurrency)]
+        sampler = gevent.spawn(self.sample_rss)
+        gevent.joinall(slots)
+        sampler.kill()
+        elapsed = time.monotonic() - start
+        return dict(concurrency=concurrency, games=finished[0], failed=failed[0], messages=self.messages, frames=self.frames,
+                    bytes_per_game=self.bytes / finished[0] if finished[0] else None,
+                    games_per_minute=60.0 * finished[0] / elapsed,
+                    latency=percentiles(self.latencies, [50, 90, 99, 100]),
+                    memory_per_game=(self.rss_peak - rss_base) / concurrency if rss_base else None)
+
+    def server_rss(self):
+        if self.server_pid is None:
+            return None
+        try:
+            with open("/proc/%i/status" % self.server_pid) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            return None
+
+    def sample_rss(self):
+        while True:
+            self.rss_peak = max(self.rss_peak, self.server_rss() or 0)
+            gevent.sleep(0.1)
+
+
+def percentiles(values, ps):
+    values = sorted(values)
+    if not values:
+        return [None] * len(ps)
+    return [values[min(len(values) - 1, int(len(values) * p / 100))] for p in ps]
+
+
+SERVERS = {"gevent": "lykan.geventserver", "asyncio": "lykan.aioserver"}
+
+
+def start_server(port, backend="gevent"):
+    server = subprocess.Popen([sys.executable, "-m", SERVERS[backend], str(port), "--no-pacing"],
+                              stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen("http://localhost:%i/" % port).read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("Server did not come up")
+
+
+def format_ms(seconds):
+    return "%7.1f" % (seconds * 1000) if seconds is not None else "      -"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plays games with websocket bots against a server and "
+                                                 "reports latencies, throughput and memory as concurrency grows.")
+    parser.add_argument("-c", "--concurrency", default="1,5,10,20",
+                        help="comma separated numbers of games played at the same time")
+    parser.add_argument("-d", "--duration", type=float, default=30, help="seconds per concurrency level")
+    parser.add_argument("-p", "--players", type=int, default=8, help="players per game")
+    parser.add_argument("--cards", type=json.loads, default=None,
+                        help="card mix as JSON, e.g. '{\"Werewolve\": 2, \"Citizen\": 6}'")
+    parser.add_argument("--url", help="base URL of a running server started with --no-pacing; "
+                                      "by default a local server is started")
+    parser.add_argument("--pid", type=int, help="process id of the server at --url to measure its memory")
+    parser.add_argument("--port", type=int, default=8099, help="port of the server started by the benchmark")
+    parser.add_argument("--server", choices=sorted(SERVERS), action="append",
+                        help="backend of the server started by the benchmark, repeat to compare backends "
+                             "(default: gevent)")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds a bot waits for a message")
+    parser.add_argument("--batch", action="store_true", help="use the batched protocol like the browsers do")
+    parser.add_argument("--compact", action="store_true", help="use the compact encoding like the browsers do")
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.compact:
+        changed = check_compact()
+        for frame, decoded in changed:
+            print("Compact encoding changed %r to %r" % (frame, decoded))
+        if changed:
+            parser.exit(1)
+    card_mix = args.cards or {"Werewolve": max(1, args.players // 4), "Seer": 1, "Witch": 1}
+    card_mix.setdefault("Citizen", args.players - sum(card_mix.values()))
+    for backend in [None] if args.url else args.server or ["gevent"]:
+        server = None
+        if backend is None:
+            base_url, pid = args.url.rstrip("/"), args.pid
+        else:
+            server = start_server(args.port, backend)
+            base_url, pid = "http://localhost:%i" % args.port, server.pid
+            print("Server: %s" % backend)
+        bench = Benchmark(base_url, args.players, card_mix, args.timeout, pid, args.batch, args.compact)
+        try:
+            print("games  done failed  games/min  msgs/s frames/s   p50 ms   p90 ms   p99 ms   max ms  KiB/game  sent KiB/game")
+            for concurrency in map(int, args.concurrency.split(",")):
+                result = bench.run_level(concurrency, args.duration, args.seed)
+                print("%5i %5i %6i %10.1f %7.0f %8.0f %s %s %s %s %9s %14s" % (
+                    concurrency, result["games"], result["failed"], result["games_per_minute"],
+                    result["messages"] / args.duration, result["frames"] / args.duration, *map(format_ms, result["latency"]),
+                    "%.0f" % (result["memory_per_game"] / 1024) if result["memory_per_game"] is not None else "-",
+                    "%.1f" % (result["bytes_per_game"] / 1024) if result["bytes_per_game"] is not None else "-"))
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == '__main__':
+    main()
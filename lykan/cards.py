@@ -12,6 +12,7 @@ def _empty_generator_method(self):
 
 
 class RoleCard:
+    __slots__ = ("player", "after_death_triggers", "is_in_love")
     TAGS = []
     RUNS_AFTER = []
     EYES_OPEN = None
@@ -36,9 +37,11 @@ class RoleCard:
 
 
 class Citizens(gameengine.Subgroup):
+    __slots__ = ()
     TITLE = _("The team of Citizens")
 
 class Werewolves(gameengine.Subgroup):
+    __slots__ = ()
     TITLE = _("The team of Werewolves")
 
 
@@ -58,33 +61,37 @@ class LovingCouple(gameengine.Subgroup, metaclass=InstanceMorphMeta):
     @classmethod
     def make_in_love(self, player):
         player.role_card.is_in_love = True
+        player.game._join_subgroup(player, self)
 
 
 class SingletonWinnerSubgroup(gameengine.Subgroup):
+    __slots__ = ()
+
     @classmethod
     def has_won(cls, game):
-        return all(not player.is_alive for player in game.players if isinstance(player.role_card, cls))
+        return not game.alive_per_subgroup[cls]
 
     @classmethod
     def compute_winner(cls, game):
-        winners = [player.role_card for player in game.players if isinstance(player.role_card, cls)]
-        if winners:
-            return winners[0]
+        if game.subgroup_members[cls]:
+            return game.subgroup_members[cls][0].role_card
 
     def materialize(self, game):
         return [self.player]
 
     @classmethod
     def validate(cls, game):
-        if len([1 for player in game.players if isinstance(player.role_card, cls)]) > 1:
+        if len(game.subgroup_members[cls]) > 1:
             raise gameengine.ValidationFailed(_("Too many cards of singleton type %s", cls.TITLE))
 
 
 class CitizensActiveAtNight(Citizens):
+    __slots__ = ()
     EYES_OPEN = gameengine.GROUP_SINGLE
 
 
 class Witch(CitizensActiveAtNight, RoleCard):
+    __slots__ = ("has_healing_potion", "has_killing_potion")
     TITLE = _("The witch")
     RUNS_AFTER = [CAN_KILL_AT_NIGHT]
     TAGS = [CAN_KILL_AT_NIGHT]
@@ -113,6 +120,7 @@ class Witch(CitizensActiveAtNight, RoleCard):
 
 
 class Werewolve(Werewolves, RoleCard):
+    __slots__ = ("to_kill",)
     TAGS = [CAN_KILL_AT_NIGHT]
     EYES_OPEN = gameengine.GROUP_SUBGROUP
 
@@ -127,26 +135,31 @@ class Werewolve(Werewolves, RoleCard):
         if votee:
             yield gameengine.InfoMessage(_("You werewolves chose to kill this player:"), players=[votee], player=self.player)
         if votee and votee not in game.hitlist:
-            game.hitlist.append(self.to_kill)
+            game.hitlist.append(votee)
 
 
 class Citizen(Citizens, RoleCard):
-    pass
+    __slots__ = ()
 
 
 class Hunter(Citizens, RoleCard):
+    __slots__ = ()
     TITLE = _("The hunter")
     def after_death(self):
         yield from super().after_death()
+        if not self.player.game.players_alive:
+            return
         yield gameengine.InfoMessage(_("And the hunter produced a shot ..."))
         yield from (yield gameengine.Select1Player(self.player, _("Who do you want to shoot?"))).kill()
 
 
 class Lynchee(SingletonWinnerSubgroup, RoleCard):
+    __slots__ = ()
     TITLE = _("The lynchee")
 
 
 class Cupid(Citizens, RoleCard):
+    __slots__ = ()
     TITLE = _("The cupid")
 
     def prepare(self):
@@ -165,6 +178,7 @@ class Cupid(Citizens, RoleCard):
 
 
 class Seer(CitizensActiveAtNight, RoleCard):
+    __slots__ = ()
     TITLE = _("The seer")
     def run_at_night(self):
         player = yield gameengine.Select1Player(self.player, _("Whose role do you want to inquire?"))
@@ -172,6 +186,7 @@ class Seer(CitizensActiveAtNight, RoleCard):
 
 
 class Prince(Citizens, RoleCard):
+    __slots__ = ("killing_attempt_happened",)
     TITLE = _("The prince")
     def __init__(self, *args):
         super().__init__(*args)
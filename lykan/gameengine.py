@@ -1,4 +1,5 @@
 import collections
+import functools
 import random
 
 from lykan import util
@@ -21,16 +22,38 @@ class AllDead(Exception):
     pass
 
 
-def compute_key(card, reduce_kind):
+def compute_key(card_cls, reduce_kind):
+    """Returns the subgroup under which cards of `card_cls` act, None if each card acts on its own."""
     if reduce_kind is GROUP_SUBGROUP:
-        return [x for x in type(card).mro() if issubclass(x, Subgroup)][0]
+        return [x for x in card_cls.mro() if issubclass(x, Subgroup)][0]
     elif reduce_kind == GROUP_SINGLE:
-        return card
+        return None
     else:
         raise NotImplementedError
 
 
+NightSlot = collections.namedtuple("NightSlot", "group prepares eyes_open key")
+
+
+@functools.lru_cache(maxsize=256)
+def compile_night(card_classes, is_first_night):
+    """Computes when the cards of each class in the frozenset `card_classes` act at night.
+
+    Returns the number of groups and a NightSlot per class. The schedule only depends on
+    which classes are alive, so games and simulations share it."""
+    groups = list(util.toposort(sorted(card_classes, key=lambda cls: cls.__name__)))
+    slots = {}
+    for group, classes in enumerate(groups):
+        for cls in classes:
+            eyes_open = cls.EYES_OPEN is not None
+            slots[cls] = NightSlot(group, hasattr(cls, "prepare") and is_first_night, eyes_open,
+                                   compute_key(cls, cls.EYES_OPEN) if eyes_open else None)
+    return len(groups), slots
+
+
 class Request:
+    __slots__ = ("player", "game")  # The game is set by the UI delivering the request.
+
     def __init__(self, player):
         self.player = player
 
@@ -39,6 +62,8 @@ class Request:
 
 
 class SelectNPlayers(Request):
+    __slots__ = ("n", "prompt", "amongst")
+
     def __init__(self, player, n, prompt, amongst=None):
         assert player is not None
         if player is Ellipsis:
@@ -50,6 +75,8 @@ class SelectNPlayers(Request):
 
 
 class Select1Player(SelectNPlayers):
+    __slots__ = ()
+
     def __init__(self, player, prompt, amongst=None):
         super().__init__(player, 1, prompt, amongst)
 
@@ -58,11 +85,15 @@ class Select1Player(SelectNPlayers):
 
 
 class EverybodySelect1Player(Select1Player):
+    __slots__ = ()
+
     def __init__(self, prompt, amongst=None):
         super().__init__(Ellipsis, prompt, amongst)
 
 
 class YesNoQuestion(Request):
+    __slots__ = ("prompt", "players")
+
     def __init__(self, player, prompt, players=None):
         assert player is not None
         super().__init__(player)
@@ -71,25 +102,50 @@ class YesNoQuestion(Request):
         
     
 class InfoMessage(Request):
-    def __init__(self, msg_or_msgs, player=None, players=None, vote=None, temporary=False, vibrate=True, fast=False):
+    __slots__ = ("msg", "players", "vote", "temporary", "vibrate", "fast", "upcoming")
+
+    def __init__(self, msg_or_msgs, player=None, players=None, vote=None, temporary=False, vibrate=True, fast=False,
+                 upcoming=None, rng=None):
         super().__init__(player)
-        self.msg = random.choice(msg_or_msgs) if isinstance(msg_or_msgs, list) else msg_or_msgs
+        if isinstance(msg_or_msgs, list):
+            assert rng is not None, "Pass the rng of the game to pick one of several messages"
+            self.msg = rng.choice(msg_or_msgs)
+        else:
+            self.msg = msg_or_msgs
         self.players = players
         self.vote = vote
         self.temporary = temporary
         self.vibrate = vibrate
         self.fast = fast
+        self.upcoming = upcoming  # Messages which are likely to follow soon.
 
 
 class Player:
-    def __init__(self, game, name):
+    __slots__ = ("game", "name", "seat", "role_card", "_is_alive")
+
+    def __init__(self, game, name, seat):
         self.game = game
         self.name = name
+        self.seat = seat
         self.role_card = None
-        self.is_alive = True
+        self._is_alive = True
+
+    @property
+    def is_alive(self):
+        return self._is_alive
+
+    @is_alive.setter
+    def is_alive(self, is_alive):
+        assert not is_alive or self._is_alive, "The dead stay dead"
+        if self._is_alive and not is_alive:
+            self._is_alive = False
+            self.game._on_death(self)
 
     def assign_role(self, card_cls):
         self.role_card = card_cls(self)
+        for cls in Subgroup.__subclasses__():
+            if isinstance(self.role_card, cls):
+                self.game._join_subgroup(self, cls)
 
     def kill(self):
         is_dead = (yield from self.role_card.kill())
@@ -99,6 +155,8 @@ class Player:
 
 
 class Session:
+    __slots__ = ("game", "player")
+
     def __init__(self, game):
         self.game = game
         self.player = None
@@ -109,39 +167,90 @@ class Session:
 
 
 class Game:
-    def __init__(self):
+    player_class = Player
+
+    def __init__(self, seed=None):
+        # All randomness of a game comes from its own RNG, so a seed and the replies reproduce it.
+        self.seed = seed if seed is not None else random.SystemRandom().getrandbits(64)
+        self.rng = random.Random(self.seed)
+        self.card_names = None
         self.players = []
         self.players_by_name = {}
         self.sessions = {}
         self.hitlist = None
+        # Kept up to date on joins and deaths, so that win checks need no scans of all players.
+        self._players_alive = None
+        self._night_plan = None
+        self.subgroup_members = collections.defaultdict(list)
+        self.alive_per_subgroup = collections.Counter()
 
     def retrieve_session(self, nonce):
         return self.sessions.setdefault(nonce, Session(self))
 
     @property
     def players_alive(self):
-        return [player for player in self.players if player.is_alive]
+        """The living players in seating order. The list is shared until the next death, do not modify it."""
+        if self._players_alive is None:
+            self._players_alive = [player for player in self.players if player.is_alive]
+        return self._players_alive
 
     def add_player(self, name):
         if name in self.players_by_name:
             raise NameClash
-        player = Player(self, name)
+        player = self.player_class(self, name, len(self.players))
         self.players.append(player)
         self.players_by_name[name] = player
+        self._players_alive = None
         return player
 
+    def _join_subgroup(self, player, cls):
+        members = self.subgroup_members[cls]
+        if player not in members:
+            members.append(player)
+            members.sort(key=lambda member: member.seat)
+            if player.is_alive:
+                self.alive_per_subgroup[cls] += 1
+
+    def _on_death(self, player):
+        self._players_alive = None
+        self._night_plan = None
+        for cls, members in self.subgroup_members.items():
+            if player in members:
+                self.alive_per_subgroup[cls] -= 1
+
+    def _plan_night(self, is_first_night):
+        """Lists the groups of the night, each mapping the title under which cards open their eyes to the cards.
+
+        The plan is kept until somebody dies, so the narration announced ahead of a night and
+        the night itself share it."""
+        if self._night_plan is not None and self._night_plan[0] == is_first_night:
+            return self._night_plan[1]
+        cards = [player.role_card for player in self.players_alive]
+        num_groups, slots = compile_night(frozenset(type(card) for card in cards), is_first_night)
+        plan = [collections.defaultdict(list) for i in range(num_groups)]
+        for card in cards:
+            slot = slots[type(card)]
+            if slot.prepares:
+                plan[slot.group][card].append(card)
+            if slot.eyes_open:
+                plan[slot.group][slot.key or card].append(card)
+        self._night_plan = (is_first_night, plan)
+        return plan
+
+    @staticmethod
+    def _narrate_night(plan):
+        for eye_openees in plan:
+            for key in eye_openees:
+                yield _("%(title)s opens their eyes.", title=_(key.TITLE))
+                yield _("%(title)s closes their eyes again.", title=_(key.TITLE))
+        yield _("Everybody opens their eyes again.")
+
     def _play_night(self, is_first_night):
         self.hitlist = []
-        yield InfoMessage(_("The night begins! Everybody closes their eyes."))
-        for cards in util.toposort(self.players):
+        plan = self._plan_night(is_first_night)
+        yield InfoMessage(_("The night begins! Everybody closes their eyes."), upcoming=list(self._narrate_night(plan)))
+        for eye_openees in plan:
             reducers = collections.defaultdict(list)
-            eye_openees = collections.defaultdict(list)
-            for card in cards:
-                if hasattr(card, "prepare") and is_first_night:
-                    eye_openees[card].append(card)
-                if card.EYES_OPEN is not None:
-                    key = compute_key(card, card.EYES_OPEN)
-                    eye_openees[key].append(card)
             for key in eye_openees:
                 yield InfoMessage(_("%(title)s opens their eyes.", title=_(key.TITLE)))
                 for card in eye_openees[key]:
@@ -157,10 +266,12 @@ class Game:
         yield InfoMessage(_("Everybody opens their eyes again."))
                 
     def _play_day(self, day_no):
-        yield InfoMessage(_("Day %(num)i begins!", num=day_no), fast=True)
+        yield InfoMessage(_("Day %(num)i begins!", num=day_no), fast=True,
+                          upcoming=[_("Discuss, dear village."), _("And the vote cast was:")])
         died = False
         for player in self.hitlist:
-            died |= yield from player.kill()
+            if player.is_alive:  # Lovers may have died together already.
+                died |= yield from player.kill()
         if not died:
             yield InfoMessage(_("Last night, nobody died."))
         self.hitlist = None
@@ -194,7 +305,9 @@ class Game:
 
     def play_game(self):
         self._validate()
-        yield InfoMessage(_("Welcome to Werewolves!"), fast=True)
+        yield InfoMessage(_("Welcome to Werewolves!"), fast=True,
+                          upcoming=[_("The night begins! Everybody closes their eyes.")] +
+                                   list(self._narrate_night(self._plan_night(is_first_night=True))))
         day = 0
         while True:
             yield from self._play_night(is_first_night=not day)
@@ -202,7 +315,7 @@ class Game:
             yield from self._play_day(day)
 
     def run_with_ui(self, ui):
-        gen = self._play_game()
+        gen = self.play_game()
         reply = None
         while True:
             try:
@@ -226,15 +339,18 @@ class Game:
         card_classes = list(iter_card_classes)
         if not len(card_classes) == len(self.players):
             raise ValidationFailed(_("Not the correct amount of cards"))
-        random.shuffle(card_classes)
+        self.card_names = [cls.__name__ for cls in card_classes]
+        self.rng.shuffle(card_classes)
         for player, card in zip(self.players, card_classes):
             player.assign_role(card)
 
 
 class Subgroup:
+    __slots__ = ()
+
     @classmethod
     def has_won(cls, game):
-        return all(isinstance(player.role_card, cls) for player in game.players_alive)
+        return game.alive_per_subgroup[cls] == len(game.players_alive)
 
     @classmethod
     def compute_winner(cls, game):
@@ -247,4 +363,4 @@ class Subgroup:
     @classmethod
     def materialize(cls, game):
         """Computes the winning members of this group."""
-        return [player for player in game.players_alive if isinstance(player.role_card, cls)]
+        return [player for player in game.subgroup_members[cls] if player.is_alive]
@@ -0,0 +1,210 @@
+if __name__ == "__main__":  # lykan.aioserver serves the same app without gevent.
+    import gevent.monkey
+    gevent.monkey.patch_all()
+
+import logging
+import queue
+import socket
+import threading
+import time
+
+import gevent
+from flask import request
+from flask_sockets import Sockets
+from gevent import pywsgi
+from geventwebsocket import WebSocketError
+from geventwebsocket.handler import WebSocketHandler
+
+from lykan.main import (app, configure, count_frame, encode_frame, make_arg_parser, mobile_client, master_client,
+                        scheduler, CompactEncoder, FrameBatch, Wait, PROFILER)
+
+
+sockets = Sockets(app)
+
+
+class Connection:
+    """A websocket with keepalive pings and bounded queues of frames in both directions.
+
+    Browsers answer pings on their own, so a peer which sends nothing for PING_TIMEOUT is
+    gone. Frames are read and written by greenlets of their own; if a phone stalls until
+    the outgoing queue is full for SEND_TIMEOUT, the connection is dropped and the client
+    resumes later."""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.game = None
+        self.closed = False
+        self.last_seen = time.monotonic()
+        self.inbox = queue.Queue(app.config["QUEUE_SIZE"])
+        self.outbox = queue.Queue(app.config["QUEUE_SIZE"])
+        self.write_lock = threading.Lock()
+        # geventwebsocket swallows pongs, so every byte read counts as a sign of life.
+        self._raw_read = ws.stream.read
+        ws.stream.read = ws.raw_read = self._read_bytes
+        self.greenlets = [gevent.spawn(self._read), gevent.spawn(self._write), gevent.spawn(self._keepalive)]
+        app.connection_stats["open"] += 1
+
+    def _read_bytes(self, size):
+        data = self._raw_read(size)
+        self.last_seen = time.monotonic()
+        return data
+
+    def send(self, data):
+        try:
+            self.outbox.put(data, timeout=app.config["SEND_TIMEOUT"])
+        except queue.Full:
+            app.connection_stats["stalled"] += 1
+            app.connection_stats["dropped_frames"] += 1
+            self.close(abort=True)
+            return
+        count_frame("out", data)
+
+    def receive(self):
+        return None if self.closed else self.inbox.get()
+
+    def _read(self):
+        while True:
+            data = self.ws.receive()
+            if data is None:
+                self.inbox.put(None)
+                return
+            if data != "__PING":  # Sent by pages loaded before the keepalive used ping frames.
+                count_frame("in", data)
+                self.inbox.put(data)
+
+    def _write(self):
+        while True:
+            data = self.outbox.get()
+            if data is None:
+                return
+            try:
+                with self.write_lock:
+                    self.ws.send(data)
+            except WebSocketError:
+                self.close(abort=True)
+                return
+
+    def _keepalive(self):
+        while True:
+            gevent.sleep(app.config["PING_INTERVAL"])
+            if time.monotonic() - self.last_seen > app.config["PING_TIMEOUT"]:
+                app.connection_stats["dead_peers"] += 1
+                self.close(abort=True)
+                return
+            try:
+                with self.write_lock:
+                    self.ws.send_frame(b"", self.ws.OPCODE_PING)
+            except WebSocketError:
+                self.close(abort=True)
+                return
+
+    def flush(self):
+        """Waits until the queued frames are written, e.g. the last ones of a game."""
+        try:
+            self.outbox.put(None, timeout=app.config["SEND_TIMEOUT"])
+        except queue.Full:
+            return
+        self.greenlets[1].join(app.config["SEND_TIMEOUT"])
+
+    def close(self, abort=False):
+        if self.closed:
+            return
+        self.closed = True
+        app.connection_stats["open"] -= 1
+        app.connection_stats["dropped_frames"] += self.outbox.qsize()
+        for greenlet in self.greenlets:
+            if greenlet is not gevent.getcurrent():
+                greenlet.kill(block=False)
+        try:
+            while True:
+                self.inbox.get_nowait()
+        except queue.Empty:
+            pass
+        self.inbox.put_nowait(None)  # Wakes up the client waiting for a reply.
+        if abort:  # A dead peer would never take a closing frame.
+            try:
+                self.ws.handler.socket.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, OSError):
+                pass
+        elif not self.ws.closed:
+            try:
+                self.ws.close()
+            except WebSocketError:
+                pass
+
+
+def run_client_on_ws(client, conn, batch=None, encoder=None):
+    reply = None
+    while not conn.closed:
+        try:
+            msg = client.send(reply)
+        except StopIteration:
+            if batch and batch.frames:
+                conn.send(encode_frame(batch.wrap(), encoder))
+            conn.flush()
+            break
+        reply = None
+        if isinstance(msg, Wait):
+            if batch and batch.frames:
+                if msg.block(batch.remaining()):
+                    continue
+                conn.send(encode_frame(batch.wrap(), encoder))
+            msg.block()
+            continue
+        if batch and batch.take(msg):
+            reply = " "
+            continue
+        conn.send(encode_frame(batch.wrap(msg) if batch else msg, encoder))
+        reply = conn.receive()
+        if reply is None:  # WS closed
+            break
+
+def make_ws_endpoint(ws, client_func):
+    conn = Connection(ws)
+    code = None
+    with gevent.Timeout(app.config["CODE_TIMEOUT"], False):
+        code = conn.receive()
+    game = app.games.get(code)
+    if game is not None:
+        game.touch()
+        game.connections.add(conn)
+        conn.game = game
+    try:
+        run_client_on_ws(client_func(game, request.args.get("since", type=int)), conn,
+                         FrameBatch() if request.args.get("batch") else None,
+                         CompactEncoder(game) if request.args.get("compact") else None)
+    finally:
+        if game is not None:
+            game.connections.discard(conn)
+        conn.close()
+
+
+PROFILER.anchors.update({
+    make_ws_endpoint.__code__: lambda local: local.get("game"),
+    Connection._read.__code__: lambda local: local["self"].game,
+    Connection._write.__code__: lambda local: local["self"].game,
+    Connection._keepalive.__code__: lambda local: local["self"].game,
+})
+
+
+@sockets.route('/mobilews')
+def mobilews(ws):
+    make_ws_endpoint(ws, mobile_client)
+
+
+@sockets.route('/masterws')
+def masterws(ws):
+    make_ws_endpoint(ws, master_client)
+
+
+def main():
+    args = make_arg_parser("Runs the Werewolves server.").parse_args()
+    scheduler.start()
+    configure(args)
+    server = pywsgi.WSGIServer(('', args.port), app, handler_class=WebSocketHandler)
+    logging.info("Serving on port %i", args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import json
+import os
+
+from lykan import gameengine
+
+
+SNAPSHOT_INTERVAL = 64
+
+
+def encode(value):
+    """Turns a reply to a request of the engine into JSON, referring to players by name."""
+    if isinstance(value, gameengine.Player):
+        return {"player": value.name}
+    elif isinstance(value, dict):
+        return {"votes": [[encode(voter), encode(votee)] for voter, votee in value.items()]}
+    elif isinstance(value, list):
+        return [encode(item) for item in value]
+    return value
+
+
+def decode(value, game):
+    if isinstance(value, dict):
+        if "player" in value:
+            return game.players_by_name[value["player"]]
+        return {decode(voter, game): decode(votee, game) for voter, votee in value["votes"]}
+    elif isinstance(value, list):
+        return [decode(item, game) for item in value]
+    return value
+
+
+class GameJournal:
+    """Records everything needed to replay a running game after a restart.
+
+    As the engine is deterministic apart from the replies it gets, a game is its header
+    (players, their cards and sessions) plus the list of replies. Every reply is appended
+    to `<code>.journal` as one line. Every SNAPSHOT_INTERVAL replies, header and replies
+    are written to `<code>.snapshot` at once and the journal starts over, so a restart
+    reads one JSON document and a few lines."""
+
+    def __init__(self, directory, code, header):
+        self.snapshot_path = os.path.join(directory, code + ".snapshot")
+        self.journal_path = os.path.join(directory, code + ".journal")
+        self.header = header
+        self.replies = []
+        self.journal = None
+        self.snapshot()
+
+    def record(self, reply):
+        self.replies.append(encode(reply))
+        if len(self.replies) % SNAPSHOT_INTERVAL == 0:
+            self.snapshot()
+        else:
+            self.journal.write(json.dumps(self.replies[-1]) + "\n")
+            self.journal.flush()
+
+    def snapshot(self):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(header=self.header, replies=self.replies), f)
+        os.replace(tmp_path, self.snapshot_path)
+        if self.journal:
+            self.journal.close()
+        self.journal = open(self.journal_path, "w")
+
+    def close(self):
+        """Forgets the game, it has ended."""
+        self.journal.close()
+        for path in (self.snapshot_path, self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def resume(cls, directory, code):
+        """Returns the journal of game `code` with the header and replies recorded so far."""
+        self = cls.__new__(cls)
+        self.snapshot_path = os.path.join(directory, code + ".snapshot")
+        self.journal_path = os.path.join(directory, code + ".journal")
+        with open(self.snapshot_path) as f:
+            snapshot = json.load(f)
+        self.header = snapshot["header"]
+        self.replies = snapshot["replies"]
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    if line.endswith("\n"):  # The last line may be torn by the crash.
+                        self.replies.append(json.loads(line))
+        self.journal = None
+        self.snapshot()
+        return self
+
+
+def recorded_codes(directory):
+    return sorted(fname[:-len(".snapshot")] for fname in os.listdir(directory) if fname.endswith(".snapshot"))
@@ -1,37 +1,68 @@
-import gevent.monkey
-gevent.monkey.patch_all()
+if __name__ == "__main__":  # Kept for existing command lines, lykan.geventserver runs the gevent server.
+    import runpy
+    runpy.run_module("lykan.geventserver", run_name="__main__", alter_sys=True)
+    raise SystemExit
 
+import argparse
 import builtins
+import collections
+import hmac
 import itertools
 import json
 import logging
 import os
-import queue
 import random
-import sys
 import threading
 import time
 
-from flask import Flask, render_template, g, redirect, url_for, send_from_directory
+from flask import Flask, Response, render_template, g, redirect, url_for, request, abort, jsonify
 from flask_babel import Babel, gettext
-from flask_sockets import Sockets
 builtins._ = lambda x, *args, **kwargs: gettext(x) % (args or kwargs)
 
 from lykan import gameengine, util, cards
+from lykan.journal import GameJournal, decode, recorded_codes
+from lykan.metrics import Metrics
+from lykan.profiler import SamplingProfiler
+from lykan.scheduler import Scheduler
+from lykan.voice import VoiceStore, get_all_voice_messages
 
 
 logging.basicConfig()
 logging.getLogger().setLevel(logging.INFO)
 app = Flask(__name__)
 babel = Babel(app)
-sockets = Sockets(app)
 app.games = {}
+app.game_stats = collections.Counter()
+app.connection_stats = collections.Counter()
+app.config.update(VOTE_TIMEOUT=None, VOTE_DEFAULT="abstain", NARRATION_GAP=1.5, READING_SPEED=15, PACING=True,
+                  SHARD=0, SHARDS=1, JOURNAL_DIR=None, LOBBY_TIMEOUT=3600, IDLE_TIMEOUT=7200, IDLE_AFTER=300,
+                  REAP_INTERVAL=60, CODE_TIMEOUT=30, MESSAGE_LOG_SIZE=32, PING_INTERVAL=20, PING_TIMEOUT=60,
+                  QUEUE_SIZE=8, SEND_TIMEOUT=10, BATCH_WINDOW=0.05, BATCH_SIZE=32, ADMIN_TOKEN=None)
+scheduler = Scheduler()  # Started by the server, on a thread or an event loop.
+METRICS = Metrics()
+METRICS.describe("lykan_request_seconds", "Time from sending a request to a client until its reply.")
+METRICS.describe("lykan_engine_seconds", "Time the scheduler spends in the game engine per step.")
+METRICS.describe("lykan_phase_seconds", "Duration of nights and days.")
+METRICS.describe("lykan_ws_frames_total", "Websocket frames sent and received.")
+METRICS.describe("lykan_ws_bytes_total", "Payload bytes of the websocket frames sent and received.")
 
 
 VOICE = _("<Voice>Brian</Voice>")
+NARRATOR_SPEEDS = (0.5, 1, 2)  # Offered on the master screen.
 _TRANSLATIONS_DIR = os.path.join(os.path.abspath(__file__ + "/.."), "translations")
 KNOWN_LANGS = ["en"] + [lang for lang in os.listdir(_TRANSLATIONS_DIR)
                         if os.path.exists(os.path.join(_TRANSLATIONS_DIR, lang, "voice")) and lang != "en"]
+VOICES = VoiceStore({lang: os.path.join(_TRANSLATIONS_DIR, lang, "voice") for lang in KNOWN_LANGS})
+
+
+def report_missing_voices():
+    for lang in KNOWN_LANGS:
+        voice_name, messages = get_all_voice_messages(_TRANSLATIONS_DIR, lang)
+        missing = VOICES.missing(lang, messages)
+        if missing:
+            logging.warning("%i of %i messages in %s have no recording, e.g. %r", len(missing), len(messages), lang, missing[0])
+        for message in missing:
+            logging.debug("No recording in %s: %r", lang, message)
 
 
 @babel.localeselector
@@ -44,15 +75,179 @@ class AlreadyPlaying(Exception):
 
 
 class Basics(gameengine.Request):
+    __slots__ = ("card_title",)
+
     def __init__(self, player, card_title):
         self.player = player
         self.card_title = card_title
 
 
+class Progress(gameengine.Request):
+    """A status line which is shown right away and does not hold up the game."""
+    __slots__ = ("msg", "players")
+    fast = True
+
+    def __init__(self, msg, player=None, players=None):
+        super().__init__(player)
+        self.msg = msg
+        self.players = players
+
+
+class ErrorMessage(gameengine.InfoMessage):
+    """Tells a player that the reply to `retry` was invalid, which is asked again after this."""
+    __slots__ = ("retry",)
+
+    def __init__(self, msg, player, retry):
+        super().__init__(msg, player)
+        self.retry = retry
+
+
+class LobbyMessage(gameengine.InfoMessage):
+    """Sent before the game starts; like Basics it is not numbered, so resuming clients never see it again."""
+    __slots__ = ()
+
+
+class Wait:
+    """Yielded by the client generators instead of blocking, so that a gevent or an asyncio
+    driver can wait for them: until `predicate` holds after a change of the game, or for
+    `timeout` seconds if there is no predicate."""
+    __slots__ = ("game", "predicate", "timeout")
+
+    def __init__(self, game, predicate=None, timeout=None):
+        self.game = game
+        self.predicate = predicate
+        self.timeout = timeout
+
+    def block(self, timeout=None):
+        """Waits at most `timeout` seconds, returns whether the wait is over."""
+        if self.predicate is None:
+            if timeout is not None and timeout < self.timeout:
+                return False
+            time.sleep(self.timeout)
+            return True
+        with self.game.changed:
+            return self.game.changed.wait_for(self.predicate, timeout if timeout is not None else self.timeout)
+
+
+class FrameBatch:
+    """Messages which need no answer but an acknowledgement, collected for a connection in the
+    batched protocol. The server acknowledges them itself and sends them along with the next
+    frame, so the client answers once per frame. Recorded narrations are never collected, the
+    master screen acknowledges them after playing them in order."""
+
+    def __init__(self):
+        self.frames = []
+        self.deadline = None
+
+    def take(self, frame):
+        if frame.get("ask") is not None or frame.get("hash") or "seq" not in frame:
+            return False
+        if len(self.frames) >= app.config["BATCH_SIZE"]:
+            return False
+        if not self.frames:
+            self.deadline = time.monotonic() + app.config["BATCH_WINDOW"]
+        self.frames.append(dict(frame, acked=True))
+        return True
+
+    def remaining(self):
+        return max(self.deadline - time.monotonic(), 0)
+
+    def wrap(self, frame=None):
+        """Returns the frame to send, with the collected messages before `frame`."""
+        if not self.frames:
+            return frame
+        frames, self.frames = self.frames + ([frame] if frame is not None else []), []
+        return dict(batch=frames)
+
+
+class CompactEncoder:
+    """Shortens the frames of a connection which asked for ?compact=1: short keys, and players
+    by seat instead of by name. A name is sent along in "r" the first time the connection refers
+    to its player."""
+
+    def __init__(self, game):
+        self.game = game
+        self.known = set()
+
+    def encode(self, frame):
+        roster = {}
+        frame = self._encode(frame, roster)
+        if roster:
+            frame["r"] = roster
+        return frame
+
+    def _encode(self, frame, roster):
+        encoded = {}
+        for key, value in frame.items():
+            if key == "batch":
+                value = [self._encode(item, roster) for item in value]
+            elif key in ("players", "joined", "amongst") and value is not None:
+                value = [self._player_id(name, roster) for name in value]
+            elif key == "player" and value is not None:
+                value = self._player_id(value, roster)
+            elif key == "vote":
+                value = [[self._player_id(voter, roster), self._player_id(votee, roster)] for voter, votee in value.items()]
+            encoded[util.COMPACT_KEYS.get(key, key)] = value
+        return encoded
+
+    def _player_id(self, name, roster):
+        player = self.game.players_by_name.get(name) if self.game else None
+        if player is None:
+            return name
+        if player.seat not in self.known:
+            self.known.add(player.seat)
+            roster[player.seat] = name
+        return player.seat
+
+
+LogEntry = collections.namedtuple("LogEntry", "seq req frame transform_reply")
+
+
+class MessageLog:
+    """The last frames sent to a player or the master screen, numbered in the order they were sent.
+
+    A client which reconnects tells the number of the last frame it got and is sent only the
+    frames after it, plus the request it still has to answer."""
+    __slots__ = ("entries", "seq")
+
+    def __init__(self, size):
+        self.entries = collections.deque(maxlen=size)
+        self.seq = 0
+
+    def record(self, req, frame, transform_reply):
+        if self.entries and self.entries[-1].req is req:  # Sent again on a new connection.
+            return self.entries[-1].frame
+        self.seq += 1
+        frame["seq"] = self.seq
+        self.entries.append(LogEntry(self.seq, req, frame, transform_reply))
+        return frame
+
+    def since(self, seq):
+        """Returns the entries after `seq` or None if they are no longer all known."""
+        first = self.entries[0].seq if self.entries else self.seq + 1
+        if not first - 1 <= seq <= self.seq:
+            return None
+        return [entry for entry in self.entries if entry.seq > seq]
+
+
 class UI:
-    def __init__(self, game, player):
-        self.gen = game.get_player_generator(player)
+    def __init__(self, game, player, since=None):
+        self.game = game
+        self.target = player or game
         self.transform_reply = None
+        self.replay = collections.deque()
+        self.replaying = None
+        missed = None
+        if since is not None and self.target.message_log.entries:
+            last = self.target.message_log.entries[-1]
+            if last.req is self.target.last_req:  # Its reply may have been lost with the connection.
+                since = min(since, last.seq - 1)
+            missed = self.target.message_log.since(since)
+        if missed is None:
+            self.gen = game.get_player_generator(player)
+        else:
+            self.replay.extend(missed)
+            self.gen = game._relay_requests(player, last.req)
 
     def __iter__(self):
         return self
@@ -61,12 +256,26 @@ class UI:
         return self.send(None)
 
     def send(self, reply):
+        if self.replaying:
+            entry, self.replaying = self.replaying, None
+            if entry.transform_reply:
+                reply = entry.transform_reply(reply)
+            self.game._post(self.game._on_reply, self.target, entry.req, reply)  # Dropped unless still pending.
+            reply = None
+        if self.replay:
+            self.replaying = self.replay.popleft()
+            return self.replaying.frame
         if self.transform_reply:
             reply = self.transform_reply(reply)
         req = self.gen.send(reply)
+        if isinstance(req, Wait):
+            self.transform_reply = None
+            return req
         ws_req, transform_reply = getattr(self, type(req).__name__)(req)
         self.transform_reply = transform_reply
-        return ws_req
+        if isinstance(req, (Basics, LobbyMessage)):  # Basics starts the numbering over on the client.
+            return ws_req
+        return self.target.message_log.record(req, ws_req, transform_reply)
 
 
 class WSUI(UI):
@@ -77,13 +286,28 @@ class WSUI(UI):
         msg = make_msg(req.msg, temporary=req.temporary)
         msg["players"] = [p.name for p in req.players or []]
         if not req.player:
-            msg["hash"] = util.gen_hash(req.msg)
+            if VOICES.has(req.game.locale, util.gen_hash(req.msg)):
+                msg["hash"] = util.gen_hash(req.msg)
+            if req.upcoming:
+                msg["prefetch"] = [name for name in map(util.gen_hash, req.upcoming) if VOICES.has(req.game.locale, name)]
         if req.vote:
             msg["vote"] = {p.name: v.name for p, v in req.vote.items()}
         if not req.vibrate:
             msg["dont_vibrate"] = True
         return msg, None
 
+    def ErrorMessage(self, req):
+        return self.InfoMessage(req)
+
+    def LobbyMessage(self, req):
+        return self.InfoMessage(req)
+
+    def Progress(self, req):
+        msg = make_msg(req.msg, temporary=True)
+        msg["players"] = [p.name for p in req.players or []]
+        msg["dont_vibrate"] = True
+        return msg, None
+
     def SelectNPlayers(self, req):
         def transform_reply(reply):
             return list(filter(None, [req.game.players_by_name.get(p_name, None) for p_name in json.loads(reply)]))
@@ -101,55 +325,101 @@ class WSUI(UI):
         return self.SelectNPlayers(req)
 
 
-class ThreadedGame(gameengine.Game, threading.Thread):
-    def __init__(self, locale, code):
-        gameengine.Game.__init__(self)
-        threading.Thread.__init__(self)
+class ScheduledPlayer(gameengine.Player):
+    __slots__ = ("last_req", "message_log")
+
+
+class ScheduledGame(gameengine.Game):
+    player_class = ScheduledPlayer
+
+    def __init__(self, locale, code, seed=None):
+        gameengine.Game.__init__(self, seed)
         self.locale = locale
         self.code = code
         self.lock = threading.Lock()
         self.game_start = threading.Event()
-        self.join_events = queue.Queue()
+        self.start_requested = False
+        self.changed = threading.Condition()
         self.nonce = None
-        self.pipe_parent, self.pipe_child = util.Pipe()
+        self.gen = None
+        self.votes = None
+        self.vote_timer = None
         self.last_req = None
+        self.speed = 1.0
+        self.quiet_at = 0
+        self.ended = False
+        self.journal = None
+        self.connections = set()
+        self.wakers = set()
+        self.message_log = MessageLog(app.config["MESSAGE_LOG_SIZE"])
+        self.last_activity = time.monotonic()
+        self.phase = None
+        self.replaying = False
+        self.vote_rng = random.Random("%s-votes" % self.seed)  # Replays take these from the journal.
 
     def add_player(self, name):
         with self.lock:
             if self.game_start.is_set():
                 raise AlreadyPlaying
-            parent_side, child_side = util.Pipe()
             player = super().add_player(name)
             player.last_req = None
-            player.pipe_child = child_side
-            player.pipe_parent = parent_side
-            self.join_events.put(None)
-            return player
+            player.message_log = MessageLog(app.config["MESSAGE_LOG_SIZE"])
+        self.touch()
+        self._notify()
+        return player
+
+    def retrieve_session(self, nonce):
+        session = self.sessions.get(nonce)
+        if session is None:
+            session = gameengine.Session(self)
+            if not self.game_start.is_set():  # Nobody can join a running game, so do not keep sessions for it.
+                self.sessions[nonce] = session
+        return session
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def idle_for(self):
+        return time.monotonic() - self.last_activity
 
     def get_player_generator(self, player):
         yield from self.gen_basics_for_player(player)  # First time.
         if player and not self.game_start.is_set():
-            yield gameengine.InfoMessage(_("Waiting for game master to start the game."), player=player, temporary=True)
-        yield from self._convert_player_pipe(player)
+            yield LobbyMessage(_("Waiting for game master to start the game."), player=player, temporary=True)
+        yield from self._relay_requests(player)
 
-    def _convert_player_pipe(self, player):
-        if player is None:
-            player = self
-        resume = player.last_req
-        pipe = player.pipe_child
+    def wait_for(self, predicate):
+        while not predicate():
+            yield Wait(self, predicate)
+
+    def _relay_requests(self, player, req=None):
+        """Yields the requests to `player` or the master screen except `req`, which was sent already."""
+        target = player or self
         while True:
-            try:
-                if resume and hasattr(resume, "game"):
-                    req = resume
-                else:
-                    req = pipe.recv()
-                    req.game = self
-                resume = False
-                if player is self and not req.fast:
-                    time.sleep(4)
-                pipe.send((yield req))
-            except StopIteration:
-                break
+            yield from self.wait_for(lambda: self.ended or target.last_req is not None and target.last_req is not req)
+            if target.last_req is None or target.last_req is req:  # The game is over.
+                return
+            req = target.last_req
+            req.game = self
+            if target is self:
+                yield from self._pace(req)
+            sent_at = time.monotonic()
+            reply = yield req
+            METRICS.observe("lykan_request_seconds", time.monotonic() - sent_at, request=type(req).__name__,
+                            target="master" if target is self else "player")
+            self._post(self._on_reply, target, req, reply)
+
+    def _pace(self, req):
+        """Waits until the previous narration and the pause after it are over."""
+        if not app.config["PACING"]:
+            return
+        if not req.fast and self.quiet_at > time.monotonic():
+            yield Wait(self, timeout=self.quiet_at - time.monotonic())
+        if isinstance(req, gameengine.InfoMessage):
+            duration = VOICES.duration(self.locale, util.gen_hash(req.msg))
+            if duration is None:  # Not recorded, give the table time to read it.
+                duration = len(req.msg) / app.config["READING_SPEED"]
+            self.quiet_at = time.monotonic() + duration + app.config["NARRATION_GAP"] / self.speed
 
     def gen_basics_for_player(self, player):
         if player:
@@ -162,54 +432,243 @@ class ThreadedGame(gameengine.Game, threading.Thread):
             yield from self.gen_basics_for_player(player)  # Second time.
         yield from super().play_game()
 
-    def run(self):
+    def _play_night(self, is_first_night):
+        return self._timed_phase("night", super()._play_night(is_first_night))
+
+    def _play_day(self, day_no):
+        return self._timed_phase("day", super()._play_day(day_no))
+
+    def position(self):
+        """Names the phase and the innermost generator of the engine in it, e.g. the card acting at night."""
+        if self.ended:
+            return "ended"
+        if self.gen is None:
+            return "lobby"
+        if self.votes is not None:
+            return "%s vote" % self.phase
+        gen, name = self.gen, None
+        while hasattr(gen, "gi_code"):  # While the engine runs, the stack of the sample shows the rest.
+            name = getattr(gen.gi_code, "co_qualname", gen.gi_code.co_name)
+            gen = gen.gi_yieldfrom
+        return "%s %s" % (self.phase or "setup", name)
+
+    def _timed_phase(self, phase, gen):
+        """Runs the phase, timed unless the game is torn down in the middle of it or it began in a
+        replay, which reaches in no time what the game took long for before the restart."""
+        self.phase = phase
+        started = None if self.replaying else time.monotonic()
+        try:
+            yield from gen
+        except gameengine.GameEnd:
+            self._observe_phase(phase, started)
+            raise
+        self._observe_phase(phase, started)
+
+    @staticmethod
+    def _observe_phase(phase, started):
+        if started is not None:
+            METRICS.observe("lykan_phase_seconds", time.monotonic() - started, phase=phase)
+
+    def begin(self):
+        with self.lock:
+            self.game_start.set()
+            self.sessions = {nonce: session for nonce, session in self.sessions.items() if session.player}
+        self.touch()
+        self.gen = self.play_game()
+        if app.config["JOURNAL_DIR"]:
+            self.journal = GameJournal(app.config["JOURNAL_DIR"], self.code, dict(
+                locale=self.locale, code=self.code, nonce=self.nonce, speed=self.speed, seed=self.seed,
+                players=[player.name for player in self.players], cards=self.card_names,
+                sessions={nonce: session.player.name for nonce, session in self.sessions.items() if session.player}))
+        self._post(self._advance, None)
+
+    @classmethod
+    def restore(cls, journal):
+        """Recreates a game from its journal, e.g. after a restart of the server."""
+        header = journal.header
+        game = cls(header["locale"], header["code"], header["seed"])
+        game.nonce = header["nonce"]
+        game.speed = header["speed"]
+        for name in header["players"]:
+            game.add_player(name)
+        game.prepare(getattr(cards, card_name) for card_name in header["cards"])  # Deals the same cards again.
+        for nonce, name in header["sessions"].items():
+            game.retrieve_session(nonce).player = game.players_by_name[name]
+        game.start_requested = True
+        game.game_start.set()
+        game.journal = journal
+        game._post(game._replay)
+        return game
+
+    def _replay(self):
+        self.gen = self.play_game()
+        req = None
+        self.replaying = True
+        try:
+            for reply in self.journal.replies:
+                req = self.gen.send(decode(reply, self))
+        except gameengine.GameEnd:
+            self._end()
+            return
+        finally:
+            self.replaying = False
+        if req is None:
+            self._advance(None)
+        else:
+            self._dispatch(req)
+
+    def _post(self, func, *args):
+        scheduler.post(self._step, func, args)
+
+    def _post_later(self, delay, func, *args):
+        return scheduler.call_later(delay, self._step, func, args)
+
+    def _step(self, func, args):
+        if self.ended:  # Replies and timers may still arrive for a reaped game.
+            return
         with app.app_context():
             activate_locale(self.locale)
-            self._run()
-        del app.games[self.code]
-
-    def _run(self):
-        self.game_start.wait()
-        gen = self.play_game()
-        reply = None
-        while True:
-            try:
-                req = gen.send(reply)
-                if req.player is None:
-                    if isinstance(req, gameengine.EverybodySelect1Player):
-                        for player in self.players_alive:
-                            player.last_req = req
-                            player.pipe_parent.send(req)
-                        votes = {}
-                        for player in self.players_alive:
-                            votee = player.pipe_parent.recv()
-                            votes[player] = req.coerce(votee)
-                        reply = votes
-                    elif isinstance(req, gameengine.InfoMessage):
-                        self.last_req = req
-                        self.pipe_parent.send(req)
-                        self.pipe_parent.recv()
-                        reply = None
-                    else:
-                        assert False, "Unsupported request"
-                else:
-                    req.player.last_req = req
-                    while True:
-                        req.player.pipe_parent.send(req)
-                        reply = req.player.pipe_parent.recv()
-                        if isinstance(req, gameengine.SelectNPlayers):
-                            if len(reply) == req.n:
-                                break
-                            else:
-                                error = gameengine.InfoMessage(_("Please select the correct amount of players."), req.player)
-                                req.player.pipe_parent.send(error)
-                                req.player.pipe_parent.recv()
-                        else:
-                            break
-                    req.player.last_req = None
-                    reply = req.coerce(reply)
-            except gameengine.GameEnd:
-                break
+            func(*args)
+
+    def _notify(self):
+        with self.changed:
+            self.changed.notify_all()
+        for waker in list(self.wakers):
+            waker()
+
+    def request_start(self):
+        self.start_requested = True
+        self.touch()
+        self._notify()
+
+    def _send(self, target, req):
+        target.last_req = req
+        self._notify()
+
+    def _advance(self, reply):
+        if self.journal:
+            self.journal.record(reply)
+        started = time.monotonic()
+        try:
+            req = self.gen.send(reply)
+        except gameengine.GameEnd:
+            self._end()
+            return
+        finally:
+            METRICS.observe("lykan_engine_seconds", time.monotonic() - started, phase=self.phase or "setup")
+        self._dispatch(req)
+
+    def _end(self):
+        app.game_stats["finished"] += 1
+        self._close()
+
+    def abandon(self):
+        """Tears down a game nobody plays any more, its players and master are disconnected."""
+        logging.info("Reaping game %s after %i idle seconds", self.code, self.idle_for())
+        app.game_stats["reaped"] += 1
+        if self.vote_timer:
+            scheduler.cancel(self.vote_timer)
+        self._close()
+        for conn in list(self.connections):
+            conn.close()
+
+    def _close(self):
+        app.games.pop(self.code, None)
+        if self.journal:
+            self.journal.close()
+        self.ended = True
+        self.gen = self.votes = self.vote_timer = None
+        self.sessions.clear()
+        self._notify()
+
+    def _dispatch(self, req):
+        if req.player is not None:
+            self._send(req.player, req)
+        elif isinstance(req, gameengine.EverybodySelect1Player):
+            self.votes = {}
+            for player in self.players_alive:
+                self._send(player, req)
+            if app.config["VOTE_TIMEOUT"]:
+                self.vote_timer = self._post_later(app.config["VOTE_TIMEOUT"], self._end_vote, req)
+            self._report_vote(req)
+        elif isinstance(req, gameengine.InfoMessage):
+            self._send(self, req)
+        else:
+            assert False, "Unsupported request"
+
+    def _on_reply(self, target, req, reply):
+        if req is not target.last_req:  # Answered before, e.g. by a previous connection.
+            return
+        self.touch()
+        target.last_req = None
+        if isinstance(req, Progress):
+            return
+        elif isinstance(req, gameengine.EverybodySelect1Player):
+            vote = req.coerce(reply)
+            if vote is not None:
+                self.votes[target] = vote
+            if self._report_vote(req):
+                return
+            reply = self._close_vote()
+        elif isinstance(req, gameengine.SelectNPlayers) and len(reply) != req.n:
+            self._send(target, ErrorMessage(_("Please select the correct amount of players."), target, req))
+            return
+        elif isinstance(req, ErrorMessage):
+            self._send(target, req.retry)
+            return
+        else:
+            reply = req.coerce(reply)
+        self._advance(reply)
+
+    def _report_vote(self, req):
+        """Shows the master screen who is still missing and returns these players."""
+        voters = self.players_alive
+        missing = [player for player in voters if player.last_req is req]
+        if missing:
+            self._send(self, Progress(_("%(num)i of %(total)i players have voted. Waiting for:",
+                                        num=len(voters) - len(missing), total=len(voters)), players=missing))
+        return missing
+
+    def _close_vote(self):
+        if self.vote_timer:
+            scheduler.cancel(self.vote_timer)
+        votes, self.votes, self.vote_timer = self.votes, None, None
+        return votes
+
+    def _end_vote(self, req):
+        """Applies the default vote to everybody who did not vote in time."""
+        if self.votes is None:
+            return
+        for player in self._report_vote(req):
+            if app.config["VOTE_DEFAULT"] == "random":
+                self.votes[player] = self.vote_rng.choice(req.amongst or self.players_alive)
+            self._send(player, Progress(_("The time to vote is up."), player=player))
+        self._advance(self._close_vote())
+
+
+def game_timeout(game):
+    return app.config["IDLE_TIMEOUT" if game.game_start.is_set() else "LOBBY_TIMEOUT"]
+
+
+def reap_games():
+    """Abandons the games which saw no activity for longer than the timeout of their phase."""
+    for game in list(app.games.values()):
+        if not game.ended and game.idle_for() > game_timeout(game):
+            game.abandon()
+    scheduler.call_later(app.config["REAP_INTERVAL"], reap_games)
+
+
+def restore_games():
+    directory = app.config["JOURNAL_DIR"]
+    for code in recorded_codes(directory):
+        if util.shard_of(code, app.config["SHARDS"]) != app.config["SHARD"]:
+            continue
+        try:
+            app.games[code] = ScheduledGame.restore(GameJournal.resume(directory, code))
+        except Exception:
+            logging.exception("Could not restore game %s", code)
+    if app.games:
+        logging.info("Restored %i games", len(app.games))
 
 
 def make_msg(msg, temporary=False):
@@ -224,7 +683,7 @@ def _check_game(game):
     return True
 
 
-def mobile_client(game):
+def mobile_client(game, since=None):
     if not (yield from _check_game(game)):
         return
     session = game.retrieve_session((yield dict(ask="nonce")))
@@ -240,10 +699,10 @@ def mobile_client(game):
     except AlreadyPlaying:
         yield make_msg(_("Game has already started."))
         return
-    yield from WSUI(game, session.player)
+    yield from WSUI(game, session.player, since)
 
 
-def master_client(game):
+def master_client(game, since=None):
     if not (yield from _check_game(game)):
         return
     nonce = (yield dict(ask="nonce"))
@@ -253,60 +712,55 @@ def master_client(game):
         yield make_msg(_("You do not have access to this game."))
         return
     if not game.game_start.is_set():
-        if game.players:
-            yield dict(ask="showplayers", players=sorted(player.name for player in game.players))
+        seen = len(game.players)  # Players joining while the master answers are shown next.
+        if seen:
+            yield dict(ask="showplayers", players=sorted(player.name for player in game.players[:seen]))
         else:
             yield make_msg(_("Waiting for players to join the game."), temporary=True)
         while True:
-            try:
-                if game.join_events.get(timeout=0.1):
-                    yield make_msg(_("%(num)i players are participating.", num=len(game.players)))
-                    break
-                else:
-                    yield dict(ask="showplayers", players=sorted(player.name for player in game.players))
-            except queue.Empty:
-                pass
+            yield from game.wait_for(lambda: game.ended or game.start_requested or len(game.players) > seen)
+            if game.ended:
+                return
+            if game.start_requested:
+                yield make_msg(_("%(num)i players are participating.", num=len(game.players)))
+                break
+            joined = game.players[seen:]
+            seen += len(joined)
+            yield dict(ask="showplayers", joined=[player.name for player in joined])
         while True:
-            selected_cards = json.loads((yield dict(ask="cards", available={cls.__name__: dict(title=_(cls.TITLE)) for cls in sorted(cards.ALL_CARDS, key=lambda c: c.__name__)})))
+            selection = json.loads((yield dict(ask="cards", available={cls.__name__: dict(title=_(cls.TITLE)) for cls in sorted(cards.ALL_CARDS, key=lambda c: c.__name__)})))
+            selected_cards = selection["cards"]
+            speed = selection.get("speed", 1)
+            if speed not in NARRATOR_SPEEDS:  # NaN is in no list, zero would divide the narration gap.
+                yield make_msg(_("Please choose one of the offered paces of the narrator."))
+                continue
+            game.speed = float(speed)
             try:
                 game.prepare(itertools.chain(*[[getattr(cards, card_name)] * count for card_name, count in selected_cards.items()]))
             except gameengine.ValidationFailed as exc:
                 yield make_msg(exc.args[0])
             else:
                 break
-        with game.lock:
-            game.game_start.set()
-    yield from WSUI(game, None)
+        game.begin()
+        since = None
+    yield from WSUI(game, None, since)
 
 
-def run_client_on_ws(client, ws):
-    reply = None
-    while not ws.closed:
-        try:
-            msg = client.send(reply)
-            ws.send(json.dumps(msg))
-            reply = "__PING"
-            while reply == "__PING":
-                reply = ws.receive()
-                if reply is None:  # WS closed
-                    break
-        except StopIteration:
-            break
+def count_frame(direction, data):
+    METRICS.inc("lykan_ws_frames_total", direction=direction)
+    METRICS.inc("lykan_ws_bytes_total", len(data), direction=direction)  # json.dumps escapes to ASCII.
 
-def make_ws_endpoint(ws, client_func):
-    code = ws.receive()
-    game = app.games.get(code)
-    client = client_func(game)
-    run_client_on_ws(client, ws)
 
-@sockets.route('/mobilews')
-def mobilews(ws):
-    make_ws_endpoint(ws, mobile_client)
+def encode_frame(msg, encoder=None):
+    return json.dumps(encoder.encode(msg) if encoder else msg, separators=(",", ":") if encoder else None)
 
 
-@sockets.route('/masterws')
-def masterws(ws):
-    make_ws_endpoint(ws, master_client)
+PROFILER = SamplingProfiler({
+    ScheduledGame._step.__code__: lambda local: local["self"],
+    ScheduledGame._relay_requests.__code__: lambda local: local["self"],
+    mobile_client.__code__: lambda local: local["game"],
+    master_client.__code__: lambda local: local["game"],
+}, ScheduledGame.position)  # The servers add the frames of their connections.
 
 
 @app.route('/')
@@ -317,22 +771,102 @@ def root():
 @app.route('/js/<locale>')
 def js(locale):
     activate_locale(locale)
-    return render_template("lykan.js.j2", locale=locale)
+    return render_template("lykan.js.j2", locale=locale, compact_keys=util.COMPACT_KEYS)
 
 
 @app.route("/voice/<locale>/<hash>")
 def voice(locale, hash):
     if locale not in KNOWN_LANGS:
         return "ERR"
-    return send_from_directory(os.path.join(_TRANSLATIONS_DIR, locale, "voice"), hash + ".mp3", cache_timeout=600)
+    voice_file = VOICES.get(locale, hash)
+    if voice_file is None:
+        abort(404)
+    response = Response(voice_file.data, mimetype="audio/mpeg")
+    response.set_etag(voice_file.etag)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(voice_file.data))
+
+
+@app.route("/stats/voice")
+def voice_stats():
+    return jsonify(hits=VOICES.hits, misses=VOICES.misses, shard=app.config["SHARD"])
+
+
+@app.route("/stats/games")
+def game_stats():
+    games = list(app.games.values())
+    running = sum(1 for game in games if game.game_start.is_set())
+    idle = sum(1 for game in games if game.idle_for() > app.config["IDLE_AFTER"])
+    return jsonify(lobby=len(games) - running, running=running, idle=idle,
+                   finished=app.game_stats["finished"], reaped=app.game_stats["reaped"], shard=app.config["SHARD"])
+
+
+@app.route("/stats/connections")
+def connection_stats():
+    return jsonify(open=app.connection_stats["open"], dead_peers=app.connection_stats["dead_peers"],
+                   stalled=app.connection_stats["stalled"], dropped_frames=app.connection_stats["dropped_frames"],
+                   shard=app.config["SHARD"])
+
+
+@app.route("/metrics")
+def metrics():
+    games = list(app.games.values())
+    running = sum(1 for game in games if game.game_start.is_set())
+    gauges = [("lykan_games", (("state", "lobby"),), len(games) - running),
+              ("lykan_games", (("state", "running"),), running),
+              ("lykan_players", (), sum(len(game.players) for game in games)),
+              ("lykan_connections", (), app.connection_stats["open"])]
+    counters = [("lykan_games_closed_total", (("reason", reason),), app.game_stats[reason])
+                for reason in ("finished", "reaped")]
+    counters += [("lykan_connection_problems_total", (("kind", kind),), app.connection_stats[kind])
+                 for kind in ("dead_peers", "stalled", "dropped_frames")]
+    counters += [("lykan_voice_requests_total", (("result", "hit"),), VOICES.hits),
+                 ("lykan_voice_requests_total", (("result", "miss"),), VOICES.misses)]
+    return Response(METRICS.render(gauges, counters, (("shard", app.config["SHARD"]),)),
+                    mimetype="text/plain; version=0.0.4")
+
+
+def check_admin_token():
+    """Lets requests with the header "Authorization: Bearer <token>" through, tokens in URLs end up in logs."""
+    scheme, space, token = request.headers.get("Authorization", "").partition(" ")
+    if not app.config["ADMIN_TOKEN"] or scheme.lower() != "bearer" or \
+            not hmac.compare_digest(token.strip().encode("utf-8"), app.config["ADMIN_TOKEN"].encode("utf-8")):
+        abort(403)
+
+
+@app.route("/admin/profile/start", methods=["POST"])
+def start_profile():
+    check_admin_token()
+    code = request.values.get("code")
+    if code is not None:
+        code = code.strip().upper()
+        if code not in app.games:
+            return "Invalid code"
+    PROFILER.start(code, min(request.values.get("seconds", 30, type=float), 600),
+                   max(request.values.get("interval", 0.01, type=float), 0.001))
+    return "OK"
+
+
+@app.route("/admin/profile/stop", methods=["POST"])
+def stop_profile():
+    check_admin_token()
+    PROFILER.stop()
+    return "OK"
+
+
+@app.route("/admin/profile")
+def download_profile():
+    check_admin_token()
+    response = Response(PROFILER.collapsed(), mimetype="text/plain")
+    response.headers["Content-Disposition"] = "attachment; filename=lykan-%s.collapsed" % (PROFILER.code or "process")
+    return response
 
 
 @app.route("/create_new_game/<locale>", methods=["POST"])
 def create_new_game(locale):
     assert locale in KNOWN_LANGS
-    code = "".join(random.choice("ABCDEFGHJKMNPQRSTUVWXYZ") for i in range(5))
-    app.games[code] = game = ThreadedGame(locale, code)
-    game.start()
+    code = util.gen_game_code(app.config["SHARD"], app.config["SHARDS"])
+    app.games[code] = ScheduledGame(locale, code, request.form.get("seed", type=int))
     return redirect(url_for("game_masterscreen", code=code))
 
 
@@ -341,7 +875,7 @@ def start_game(code, nonce):
     game = app.games[code]
     if nonce != game.nonce:
         return "Nonce error"
-    game.join_events.put(True)
+    game.request_start()
     return "OK"
 
 
@@ -367,11 +901,40 @@ def game(code):
     return render_screen("game", "mobile.html.j2", code)
 
 
-if __name__ == "__main__":
-    from gevent import pywsgi
-    from geventwebsocket.handler import WebSocketHandler
-    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
-    server = pywsgi.WSGIServer(('', port), app, handler_class=WebSocketHandler)
+def make_arg_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("port", type=int, nargs="?", default=8080)
+    parser.add_argument("--vote-timeout", type=float, help="seconds the village has for a vote")
+    parser.add_argument("--vote-default", choices=["abstain", "random"], default="abstain",
+                        help="vote of the players who missed the vote timeout")
+    parser.add_argument("--narration-gap", type=float, default=1.5,
+                        help="seconds of silence after each narration at normal speed")
+    parser.add_argument("--no-pacing", dest="pacing", action="store_false",
+                        help="send narrations without waiting for the previous one, for benchmarks")
+    parser.add_argument("--shard", type=int, default=0, help="number of this worker behind lykan.router")
+    parser.add_argument("--shards", type=int, default=1, help="number of workers behind lykan.router")
+    parser.add_argument("--journal-dir", help="directory to record running games in, they are resumed on restart")
+    parser.add_argument("--lobby-timeout", type=float, default=3600,
+                        help="seconds after which a game which was never started is removed")
+    parser.add_argument("--idle-timeout", type=float, default=7200,
+                        help="seconds after which a running game without any reply is removed")
+    parser.add_argument("--ping-interval", type=float, default=20, help="seconds between websocket pings")
+    parser.add_argument("--ping-timeout", type=float, default=60,
+                        help="seconds of silence after which a client counts as gone")
+    parser.add_argument("--admin-token", help="secret to pass as \"Authorization: Bearer SECRET\" to the /admin routes, "
+                                                  "which are off without it")
+    return parser
+
+
+def configure(args):
+    """Applies the command line and restores the recorded games, the server starts after this."""
+    app.config.update(VOTE_TIMEOUT=args.vote_timeout, VOTE_DEFAULT=args.vote_default, NARRATION_GAP=args.narration_gap,
+                      PACING=args.pacing, SHARD=args.shard, SHARDS=args.shards,
+                      JOURNAL_DIR=args.journal_dir, LOBBY_TIMEOUT=args.lobby_timeout, IDLE_TIMEOUT=args.idle_timeout,
+                      PING_INTERVAL=args.ping_interval, PING_TIMEOUT=args.ping_timeout, ADMIN_TOKEN=args.admin_token)
     logging.info("Werewolves started")
-    logging.info("Serving on port %i", port)
-    server.serve_forever()
+    report_missing_voices()
+    if args.journal_dir:
+        os.makedirs(args.journal_dir, exist_ok=True)
+        restore_games()
+    reap_games()
@@ -0,0 +1,86 @@
+import bisect
+import collections
+import threading
+
+
+# Upper bounds in seconds, from a websocket round trip to a whole night.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for key, value in labels)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # The last one counts the values above all bounds.
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.sum += value
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+
+
+class Metrics:
+    """Counters and histograms of one process, written in the Prometheus text format.
+
+    Values are kept per metric name and label set; the lock is only held for the update
+    of a single value, so the hot paths pay a dictionary lookup and an addition."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.histograms = collections.defaultdict(Histogram)
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.histograms[key].observe(value)
+
+    def render(self, gauges=(), counters=(), common=()):
+        """Returns all values plus `gauges` and `counters`, (name, labels, value) tuples taken at the time
+        of the scrape from state which is kept elsewhere anyway. Every value is labelled with `common`."""
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append("# HELP %s %s" % (name, self.help[name]))
+                lines.append("# TYPE %s %s" % (name, kind))
+
+        with self.lock:
+            counters = sorted([((name, labels), value) for name, labels, value in counters] + list(self.counters.items()))
+            histograms = sorted((key, list(hist.counts), hist.sum) for key, hist in self.histograms.items())
+        for name, labels, value in sorted(gauges, key=lambda gauge: gauge[:2]):
+            header(name, "gauge")
+            lines.append("%s%s %s" % (name, format_labels(common + labels), value))
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append("%s%s %s" % (name, format_labels(common + labels), value))
+        for (name, labels), counts, total in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(BUCKETS, counts):
+                cumulative += count
+                lines.append("%s_bucket%s %i" % (name, format_labels(common + labels + (("le", bound),)), cumulative))
+            count = cumulative + counts[-1]
+            lines.append("%s_bucket%s %i" % (name, format_labels(common + labels + (("le", "+Inf"),)), count))
+            lines.append("%s_sum%s %s" % (name, format_labels(common + labels), total))
+            lines.append("%s_count%s %i" % (name, format_labels(common + labels), count))
+        return "\n".join(lines) + "\n"
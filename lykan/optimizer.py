@@ -0,0 +1,132 @@
+import argparse
+import builtins
+import collections
+import concurrent.futures
+import itertools
+import math
+builtins._ = lambda x, *args, **kwargs: x % (args or kwargs)
+from lykan import cards, gameengine, simulator
+
+
+def candidate_mixes(num_players, max_per_card=1):
+    """Yields the card mixes for `num_players` which pass the validation of the game.
+
+    Werewolves range from one to less than half of the players, Citizens fill up
+    the remaining places and every other card is used at most `max_per_card` times."""
+    specials = [cls for cls in cards.ALL_CARDS if cls is not cards.Citizen and not issubclass(cls, cards.Werewolves)]
+    for num_werewolves in range(1, (num_players + 1) // 2):
+        for counts in itertools.product(range(max_per_card + 1), repeat=len(specials)):
+            num_citizens = num_players - num_werewolves - sum(counts)
+            if num_citizens < 0:
+                continue
+            mix = {cls.__name__: count for cls, count in zip(specials, counts) if count}
+            mix[cards.Werewolve.__name__] = num_werewolves
+            if num_citizens:
+                mix[cards.Citizen.__name__] = num_citizens
+            card_names = simulator.expand_mix(mix)
+            if _is_valid(card_names):
+                yield card_names
+
+
+def _is_valid(card_names):
+    game = gameengine.Game()
+    for i in range(len(card_names)):
+        game.add_player("Player %i" % i)
+    try:
+        game.prepare(getattr(cards, card_name) for card_name in card_names)
+        game._validate()
+    except gameengine.ValidationFailed:
+        return False
+    return True
+
+
+def wilson_interval(successes, trials, z):
+    if not trials:
+        return 0.0, 1.0
+    p = successes / trials
+    denominator = 1 + z * z / trials
+    centre = (p + z * z / (2 * trials)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+    return centre - half_width, centre + half_width
+
+
+class Candidate:
+    def __init__(self, card_names):
+        self.card_names = card_names
+        self.winners = collections.Counter()
+
+    @property
+    def games(self):
+        return sum(self.winners.values())
+
+    @property
+    def duels(self):
+        return self.winners["Citizens"] + self.winners["Werewolves"]
+
+    @property
+    def citizen_rate(self):
+        return self.winners["Citizens"] / self.duels if self.duels else None
+
+    def imbalance_bounds(self, z):
+        """Bounds of the distance of the Citizens-vs-Werewolves win rate to 50%."""
+        low, high = wilson_interval(self.winners["Citizens"], self.duels, z)
+        if low <= 0.5 <= high:
+            return 0.0, max(0.5 - low, high - 0.5)
+        return min(abs(low - 0.5), abs(high - 0.5)), max(abs(low - 0.5), abs(high - 0.5))
+
+
+def optimize(num_players, top=5, batch_size=200, max_games=20000, tolerance=0.02, z=2.58,
+             seed=0, strategy="random", workers=None, max_per_card=1):
+    """Races all candidate mixes against each other in batches of seeded games.
+
+    After every batch, a mix is dropped once the lower bound of its imbalance exceeds
+    the upper bound of the `top`-th best mix. The race ends when only `top` mixes are
+    left and their estimates are precise to `tolerance`, or after `max_games` games.
+    Returns the `top` candidates, the most balanced first."""
+    alive = [Candidate(card_names) for card_names in candidate_mixes(num_players, max_per_card)]
+    played = 0
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        while alive and played < max_games:
+            seeds = range(seed + played, seed + played + batch_size)
+            futures = {executor.submit(simulator.play_batch, candidate.card_names, seeds, strategy): candidate
+                       for candidate in alive}
+            for future in concurrent.futures.as_completed(futures):
+                futures[future].winners.update(future.result())
+            played += batch_size
+            bounds = {candidate: candidate.imbalance_bounds(z) for candidate in alive}
+            threshold = sorted(high for low, high in bounds.values())[min(top, len(alive)) - 1]
+            alive = [candidate for candidate in alive if bounds[candidate][0] <= threshold]
+            if len(alive) <= top and all(high - low <= 2 * tolerance for low, high in
+                                         (wilson_interval(c.winners["Citizens"], c.duels, z) for c in alive)):
+                break
+    return sorted(alive, key=lambda candidate: candidate.imbalance_bounds(z)[1])[:top]
+
+
+def parse_player_counts(text):
+    first, _, last = text.partition("-")
+    return range(int(first), int(last or first) + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Searches the card mixes where Citizens and Werewolves win equally often.")
+    parser.add_argument("players", type=parse_player_counts, nargs="+", metavar="N[-M]", help="player counts")
+    parser.add_argument("-t", "--top", type=int, default=5, help="mixes to report per player count")
+    parser.add_argument("-b", "--batch-size", type=int, default=200, help="games per mix and round")
+    parser.add_argument("-n", "--max-games", type=int, default=20000, help="games per mix at most")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="precision of the reported win rates")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="seed of the first game")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="worker processes")
+    parser.add_argument("--strategy", choices=sorted(simulator.STRATEGIES), default="random")
+    args = parser.parse_args()
+    for num_players in sorted(set(itertools.chain(*args.players))):
+        print("%i players:" % num_players)
+        for candidate in optimize(num_players, args.top, args.batch_size, args.max_games, args.tolerance,
+                                  seed=args.seed, strategy=args.strategy, workers=args.workers):
+            print("  %5.1f%% Citizens (%i games)  %s" % (
+                100.0 * (candidate.citizen_rate or 0), candidate.games,
+                ", ".join("%ix %s" % (count, card_name) for card_name, count in
+                          sorted(collections.Counter(candidate.card_names).items()))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import _thread
+import collections
+import os
+import sys
+import time
+
+
+def _unpatched():
+    """Returns start_new_thread, get_ident and sleep of a real thread, even when gevent has patched
+    threading, or the sampler would only run when the greenlets let it. Does not import gevent, the
+    asyncio server runs without it."""
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is None or not monkey.is_module_patched("threading"):
+        return _thread.start_new_thread, _thread.get_ident, time.sleep
+    return (monkey.get_original("_thread", "start_new_thread"), monkey.get_original("_thread", "get_ident"),
+            monkey.get_original("time", "sleep"))
+
+
+# Innermost frames of hubs, event loops and threads with nothing to do.
+IDLE = {("hub.py", "run"), ("selectors.py", "select"), ("threading.py", "wait"), ("_threading.py", "acquire_with_timeout")}
+
+
+def format_code(code):
+    return "%s (%s:%i)" % (getattr(code, "co_qualname", code.co_name),
+                           "/".join(code.co_filename.split(os.sep)[-2:]), code.co_firstlineno)
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads of the process from a thread of its own.
+
+    Under gevent the greenlets share the main thread, whose current frame belongs to the
+    greenlet running at the time of the sample, so the samples show where the greenlets
+    spend the CPU; samples of idle hubs and threads are dropped. A sample belongs to the
+    game found in the innermost frame of `anchors`, which maps code objects to a function
+    taking the locals of their frame and returning the game, and is labelled with
+    `describe(game)`."""
+
+    def __init__(self, anchors, describe):
+        self.anchors = anchors
+        self.describe = describe
+        self.stacks = collections.Counter()
+        self.code = None
+        self.deadline = 0
+        self.generation = 0
+
+    @property
+    def running(self):
+        return time.monotonic() < self.deadline
+
+    def start(self, code=None, seconds=60, interval=0.01):
+        """Samples game `code` or the whole process for at most `seconds`, forgetting earlier samples."""
+        self.generation += 1
+        self.stacks = collections.Counter()
+        self.code = code
+        self.deadline = time.monotonic() + seconds
+        start_new_thread, get_ident, sleep = _unpatched()
+        start_new_thread(self._run, (self.generation, interval, get_ident, sleep))
+
+    def stop(self):
+        self.generation += 1
+        self.deadline = 0
+
+    def _run(self, generation, interval, get_ident, sleep):
+        own = get_ident()
+        while generation == self.generation and self.running:
+            sleep(interval)
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._sample(frame)
+
+    def _sample(self, frame):
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in IDLE:
+            return
+        stack = []
+        game = None
+        while frame is not None:
+            stack.append(frame.f_code)
+            if game is None and frame.f_code in self.anchors:
+                game = self.anchors[frame.f_code](frame.f_locals)
+            frame = frame.f_back
+        if game is None:
+            if self.code is not None:
+                return
+            labels = ("no game",)
+        elif self.code is not None and game.code != self.code:
+            return
+        else:
+            labels = ("game " + game.code, self.describe(game))
+        stack.reverse()
+        self.stacks[labels + tuple(stack)] += 1
+
+    def collapsed(self):
+        """Returns the samples as collapsed stacks, the input of flamegraph.pl, speedscope and others."""
+        lines = collections.Counter()
+        for key, count in dict.copy(self.stacks).items():  # Copied at once, the sampler keeps adding.
+            lines[";".join(item if isinstance(item, str) else format_code(item) for item in key)] += count
+        return "".join("%s %i\n" % line for line in sorted(lines.items()))
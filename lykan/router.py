@@ -0,0 +1,134 @@
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import itertools
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import urllib.parse
+
+import gevent
+from gevent.server import StreamServer
+
+from lykan import util
+
+
+MAX_HEADER_SIZE = 65536
+# Top level paths which do not name a game; everything else is routed by its first path segment.
+SHARED_PATHS = {"", "js", "voice", "static", "create_new_game", "favicon.ico"}
+# Paths about the worker which answers them, routed by the shard query parameter, 0 without it.
+WORKER_PATHS = {"metrics", "stats"}
+
+
+class Router:
+    """Forwards every connection to the worker process which hosts the game it is about.
+
+    The first letter of a game code names its worker (see util.gen_game_code), so routing
+    needs no shared state. Plain HTTP connections carry a single request each, websockets
+    are passed through untouched once the worker accepted them."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.next_worker = itertools.cycle(range(len(workers)))
+
+    def pick_worker(self, path):
+        url = urllib.parse.urlsplit(path)
+        segments = url.path.split("/")[1:]
+        if segments[0] in ("mobilews", "masterws", "admin"):
+            code = urllib.parse.parse_qs(url.query).get("code", [""])[0]
+        elif segments[0] in WORKER_PATHS:
+            shard = urllib.parse.parse_qs(url.query).get("shard", ["0"])[0]
+            return self.workers[int(shard) % len(self.workers) if shard.isdigit() else 0]
+        elif segments[0] in ("start_game", "master") and len(segments) > 1:
+            code = segments[1]
+        elif segments[0] not in SHARED_PATHS:
+            code = segments[0]
+        else:
+            return self.workers[next(self.next_worker)]
+        return self.workers[util.shard_of(code, len(self.workers))]
+
+    def handle(self, client, address):
+        upstream = None
+        try:
+            head = b""
+            while b"\r\n\r\n" not in head:
+                data = client.recv(4096)
+                if not data or len(head) > MAX_HEADER_SIZE:
+                    return
+                head += data
+            head, body = head.split(b"\r\n\r\n", 1)
+            request_line, *headers = head.split(b"\r\n")
+            path = request_line.split(b" ")[1].decode("latin-1")
+            if not any(header.lower().startswith(b"upgrade:") for header in headers):
+                # Every request may belong to another worker, so keep-alive cannot be allowed.
+                headers = [header for header in headers if not header.lower().startswith((b"connection:", b"keep-alive:"))]
+                headers.append(b"Connection: close")
+            upstream = socket.create_connection(self.pick_worker(path))
+            upstream.sendall(b"\r\n".join([request_line] + headers) + b"\r\n\r\n" + body)
+            gevent.joinall([gevent.spawn(pipe, client, upstream), gevent.spawn(pipe, upstream, client)])
+        except (OSError, IndexError) as exc:
+            logging.debug("Connection from %r failed: %r", address, exc)
+        finally:
+            if upstream is not None:
+                upstream.close()
+            client.close()
+
+
+def pipe(source, destination):
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            destination.sendall(data)
+    except OSError:
+        pass
+    try:
+        destination.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+def start_workers(num_workers, base_port, worker_args):
+    return [subprocess.Popen([sys.executable, "-m", "lykan.geventserver", str(base_port + i),
+                              "--shard", str(i), "--shards", str(num_workers)] + worker_args)
+            for i in range(num_workers)]
+
+
+def watch_worker(process):
+    process.wait()
+    logging.error("Worker %i exited with %i, its games are lost", process.pid, process.returncode)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the Werewolves server on several worker processes. "
+                                                 "Further arguments are passed to the workers.")
+    parser.add_argument("port", type=int, nargs="?", default=8080)
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="worker processes, one per core by default")
+    parser.add_argument("--base-port", type=int, help="port of the first worker, the following ports are used "
+                                                      "by the other workers (default: port + 1)")
+    args, worker_args = parser.parse_known_args()
+    logging.basicConfig(level=logging.INFO)
+    num_workers = max(1, min(args.workers, len(util.CODE_LETTERS)))
+    base_port = args.base_port or args.port + 1
+    processes = start_workers(num_workers, base_port, worker_args)
+    for process in processes:
+        gevent.spawn(watch_worker, process)
+    router = Router([("127.0.0.1", base_port + i) for i in range(num_workers)])
+    logging.info("Routing port %i to %i workers", args.port, num_workers)
+    server = StreamServer(("", args.port), router.handle)
+    gevent.signal_handler(signal.SIGTERM, server.stop)
+    try:
+        server.serve_forever()
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+
+
+class Scheduler:
+    """Runs the steps of all games of this process one after another, on a thread of its own
+    or as callbacks of an asyncio event loop, which then is the only one to touch the games."""
+
+    def __init__(self):
+        self.events = queue.Queue()
+        self.timers = []
+        self.counter = itertools.count()
+        self.thread = None
+        self.loop = None
+
+    def start(self, loop=None):
+        """Starts running the steps, before anything is posted."""
+        if loop is not None:
+            self.loop = loop
+            return
+        self.thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+        self.thread.start()
+
+    def post(self, func, *args):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._call, func, args)
+        else:
+            self.events.put((func, args))
+
+    def call_later(self, delay, func, *args):
+        timer = [time.monotonic() + delay, next(self.counter), func, args]
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.call_later, delay, self._fire, timer)
+        else:
+            self.post(heapq.heappush, self.timers, timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        timer[2] = None
+
+    def run(self):
+        while True:
+            timeout = max(self.timers[0][0] - time.monotonic(), 0) if self.timers else None
+            try:
+                func, args = self.events.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                self._call(func, args)
+            while self.timers and self.timers[0][0] <= time.monotonic():
+                deadline, seq, func, args = heapq.heappop(self.timers)
+                if func is not None:
+                    self._call(func, args)
+
+    def _fire(self, timer):
+        if timer[2] is not None:
+            self._call(timer[2], timer[3])
+
+    def _call(self, func, args):
+        try:
+            func(*args)
+        except Exception:
+            logging.exception("Scheduled call %r failed", func)
@@ -1,5 +1,9 @@
+import argparse
 import builtins
-builtins._ = lambda x, *args: (x % args) if args else x
+import collections
+import concurrent.futures
+import random
+builtins._ = lambda x, *args, **kwargs: x % (args or kwargs)
 from lykan import cards, gameengine
 
 
@@ -38,7 +42,121 @@ class TestUI:
             1/0
 
 
-if __name__ == '__main__':
+class RandomBot:
+    """Answers every request of every player with a random choice."""
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def choose(self, game, player, candidates, n):
+        return self.rng.sample(candidates, min(n, len(candidates)))
+
+    def handle(self, game, req):
+        if isinstance(req, gameengine.InfoMessage):
+            return
+        elif isinstance(req, gameengine.EverybodySelect1Player):
+            candidates = req.amongst or game.players_alive
+            return {player: req.coerce(self.choose(game, player, candidates, 1)) for player in game.players_alive}
+        elif isinstance(req, gameengine.SelectNPlayers):
+            return req.coerce(self.choose(game, req.player, req.amongst or game.players_alive, req.n))
+        elif isinstance(req, gameengine.YesNoQuestion):
+            return self.rng.random() < 0.5
+        else:
+            raise NotImplementedError
+
+
+class TeamBot(RandomBot):
+    """Like RandomBot, but never picks itself or a known ally among all living players."""
+
+    def choose(self, game, player, candidates, n):
+        if candidates is game.players_alive:
+            candidates = [candidate for candidate in candidates if not self.is_ally(player, candidate)] or candidates
+        return super().choose(game, player, candidates, n)
+
+    @staticmethod
+    def is_ally(player, other):
+        if player is other:
+            return True
+        if isinstance(player.role_card, cards.Werewolves) and isinstance(other.role_card, cards.Werewolves):
+            return True
+        return isinstance(player.role_card, cards.LovingCouple) and isinstance(other.role_card, cards.LovingCouple)
+
+
+STRATEGIES = {"random": RandomBot, "team": TeamBot}
+
+
+def play(card_names, seed, strategy="random"):
+    """Plays one game with bots only and returns the name of the winning group (None if all died)."""
+    game = gameengine.Game(seed)
+    for i in range(len(card_names)):
+        game.add_player("Player %i" % i)
+    game.prepare(getattr(cards, card_name) for card_name in card_names)
+    try:
+        game.run_with_ui(STRATEGIES[strategy](random.Random("bot-%i" % seed)))
+    except gameengine.GameEnd:
+        pass
+    try:
+        winner = game.who_has_won()
+    except gameengine.AllDead:
+        return None
+    return winner.__name__ if isinstance(winner, type) else type(winner).__name__
+
+
+def play_batch(card_names, seeds, strategy):
+    return collections.Counter(play(card_names, seed, strategy) for seed in seeds)
+
+
+def expand_mix(mix):
+    return tuple(sorted(card_name for card_name, count in mix.items() for i in range(count)))
+
+
+def simulate(mixes, games, seed=0, strategy="random", workers=None, batch_size=1000):
+    """Plays `games` seeded games of every card mix on a process pool.
+
+    Every mix is played with the same seeds, so the mixes are compared on equal terms.
+    Returns a dict mapping each expanded mix to a Counter of winning groups."""
+    results = {expand_mix(mix): collections.Counter() for mix in mixes}
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = {}
+        for card_names in results:
+            for start in range(seed, seed + games, batch_size):
+                seeds = range(start, min(start + batch_size, seed + games))
+                futures[executor.submit(play_batch, card_names, seeds, strategy)] = card_names
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]].update(future.result())
+    return results
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        card_name, _, count = item.partition("=")
+        if getattr(cards, card_name, None) not in cards.ALL_CARDS:
+            raise argparse.ArgumentTypeError("unknown card %r" % card_name)
+        mix[card_name] = mix.get(card_name, 0) + int(count or 1)
+    return mix
+
+
+def report(results):
+    for card_names, winners in results.items():
+        total = sum(winners.values())
+        print(", ".join("%ix %s" % (count, card_name) for card_name, count in sorted(collections.Counter(card_names).items())))
+        for winner, count in winners.most_common():
+            print("  %-14s %6.2f%%" % (winner or "Nobody", 100.0 * count / total))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plays Werewolves with bots and reports the win rates per group.")
+    parser.add_argument("mixes", nargs="*", type=parse_mix, metavar="CARD=COUNT,...",
+                        help="card mixes to simulate; without any, an interactive test game is played")
+    parser.add_argument("-n", "--games", type=int, default=10000, help="games per mix")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="seed of the first game")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="worker processes")
+    parser.add_argument("--strategy", choices=sorted(STRATEGIES), default="random")
+    args = parser.parse_args()
+    if args.mixes:
+        report(simulate(args.mixes, args.games, args.seed, args.strategy, args.workers))
+        return
     ui = TestUI()
     game = gameengine.Game()
     game.add_player("Brian").assign_role(cards.Witch)
@@ -54,3 +172,7 @@ if __name__ == '__main__':
         game.run_with_ui(ui)
     except gameengine.GameEnd:
         print("Regular end. EOF.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,74 +1,197 @@
 # Run as "python3 -m lykan.speechloader" to regenerate voice data.
 
+import argparse
+import concurrent.futures
+import json
 import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
 import builtins
 builtins._ = lambda x, *args: (x % args) if args else x
 
-from babel.messages.pofile import read_po
-from boto3 import Session
-
-from lykan import cards, util, gameengine
+from lykan import util
+from lykan.voice import get_all_voice_messages
 
 
 TRANSLATIONS_DIR = os.path.join(os.path.abspath(__file__ + "/.."), "translations")
-
-session = Session(profile_name="default")
-polly = session.client("polly")
-
-
-def get_all_raw_messages(locale):
-    transfilename = os.path.join(TRANSLATIONS_DIR, locale, "LC_MESSAGES", "messages.po")
-    catalog = read_po(open(transfilename, "r"))
-    voice_name = None
-    for message in catalog:
-        if "<Voice>" in message.id:
-            voice_name = (message.string or message.id).split("<Voice>", 1)[1].split("</", 1)[0]
-    yield (catalog, voice_name) if voice_name else (None, "Unknown")
-    for message in catalog:
-        txt = message.string or message.id
-        if "python-format" in message.flags and "%(" not in txt or message.fuzzy or "<" in txt or \
-                any(fname.endswith("j2") for fname, _ in message.locations):
-            continue
-        yield txt
-
-
-def get_all_titles(catalog):
-    return {catalog[c.TITLE].string or catalog[c.TITLE].id for c in cards.ALL_CARDS + gameengine.Subgroup.__subclasses__() if hasattr(c, "TITLE")}
-
-
-def get_all_potential_messages(messages_iter, **kwargs):
-    for message in messages_iter:
-        if "%(" in message:
-            groupname = message.split("%(", 1)[1].split(")", 1)[0]
-            for value in kwargs[groupname]:
-                yield message % {groupname: value}
-        else:
-            yield message % ()
-
-
-def create_cache_file(voice, text, directory):
-    fname = util.gen_hash(text) + ".mp3"
-    path = os.path.join(directory, fname)
-    if os.path.exists(path):
-        return
-    response = polly.synthesize_speech(Text=text, VoiceId=voice, OutputFormat="mp3")
-    with open(path, "wb") as f:
-        f.write(response.get("AudioStream").read())
-    return True
+MANIFEST_NAME = "manifest.json"
+JOURNAL_NAME = "journal.jsonl"
+
+
+class PollyBackend:
+    name = "polly"
+
+    def __init__(self, profile_name="default"):
+        from boto3 import Session
+        self.polly = Session(profile_name=profile_name).client("polly")
+
+    def synthesize(self, voice, text):
+        response = self.polly.synthesize_speech(Text=text, VoiceId=voice, OutputFormat="mp3")
+        return response.get("AudioStream").read()
+
+
+class SilenceBackend:
+    """Generates silent MP3 files as long as a speaker would need for the text, for offline runs."""
+    name = "silence"
+    # MPEG-2 layer III, 8 kbit/s, 22050 Hz, mono: 26 bytes and 576 samples per frame.
+    FRAME = bytes([0xff, 0xf3, 0x10, 0xc0]) + bytes(22)
+    FRAMES_PER_SECOND = 22050 / 576
+
+    def __init__(self, chars_per_second=15):
+        self.chars_per_second = chars_per_second
+
+    def synthesize(self, voice, text):
+        return self.FRAME * max(1, round(len(text) / self.chars_per_second * self.FRAMES_PER_SECOND))
+
+
+class CommandBackend:
+    """Runs a local TTS command which gets {voice} substituted, reads the text from stdin and writes MP3 to stdout.
+
+    The text never becomes part of the command line, so narrations with quotes or $ are safe in shell pipelines."""
+    name = "command"
+
+    def __init__(self, command):
+        self.command = shlex.split(command)
+
+    def synthesize(self, voice, text):
+        return subprocess.run([arg.format(voice=voice) for arg in self.command], input=text.encode("utf-8"),
+                              stdout=subprocess.PIPE, check=True).stdout
+
+
+class VoiceDirectory:
+    """The recordings of one locale with a manifest of which text and voice each was made from.
+
+    Every finished recording is appended to a journal first, so an aborted run resumes where
+    it stopped; the journal is folded into the manifest when the run completes. Recordings
+    without a voice in the manifest, made before there was one, are kept by the first run and
+    taken to be of its voice, so a later change of the voice records them again."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+        self.journal_path = os.path.join(directory, JOURNAL_NAME)
+        self.lock = threading.Lock()
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    if line.endswith("\n"):  # The last line of an aborted run may be torn.
+                        entry = json.loads(line)
+                        self.manifest[entry.pop("hash")] = entry
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".mp3")
+
+    def is_current(self, name, voice):
+        if not os.path.exists(self.path(name)):
+            return False
+        entry = self.manifest.get(name)
+        return entry is None or entry["voice"] in (None, voice)
+
+    def store(self, name, text, voice, backend, data):
+        tmp_path = self.path(name) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(name))
+        entry = dict(text=text, voice=voice, backend=backend)
+        with self.lock:
+            self.manifest[name] = entry
+            with open(self.journal_path, "a") as f:
+                f.write(json.dumps(dict(entry, hash=name)) + "\n")
+
+    def orphans(self, names):
+        return [fname[:-len(".mp3")] for fname in os.listdir(self.directory)
+                if fname.endswith(".mp3") and fname[:-len(".mp3")] not in names]
+
+    def commit(self, texts, voice):
+        for name, text in texts.items():
+            if self.manifest.get(name, {}).get("voice") is None:
+                self.manifest[name] = dict(text=text, voice=voice, backend=None)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+
+def synthesize_with_retries(backend, voice, text, retries):
+    for attempt in range(retries + 1):
+        try:
+            return backend.synthesize(voice, text)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def rebuild_locale(locale, backend, jobs=8, retries=3, force=False, prune=False):
+    """Records all texts of `locale` whose recording is missing or made with another voice.
+
+    Returns the texts which could not be recorded."""
+    directory = VoiceDirectory(os.path.join(TRANSLATIONS_DIR, locale, "voice"))
+    voice_name, messages = get_all_voice_messages(TRANSLATIONS_DIR, locale)
+    texts = {util.gen_hash(message): message for message in messages}
+    todo = {name: text for name, text in texts.items() if force or not directory.is_current(name, voice_name)}
+    print("%s: %i of %i texts to record with voice %s" % (locale, len(todo), len(texts), voice_name))
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = {executor.submit(synthesize_with_retries, backend, voice_name, text, retries): name
+                   for name, text in todo.items()}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                directory.store(name, texts[name], voice_name, backend.name, future.result())
+            except Exception as exc:
+                print("Failed", texts[name], exc, file=sys.stderr)
+                failed.append(texts[name])
+            else:
+                print("Generated", texts[name])
+    orphans = directory.orphans(texts)
+    if prune:
+        for name in orphans:
+            os.remove(directory.path(name))
+            directory.manifest.pop(name, None)
+        print("%s: removed %i unused recordings" % (locale, len(orphans)))
+    elif orphans:
+        print("%s: %i unused recordings, delete them with --prune" % (locale, len(orphans)))
+    if not failed:
+        directory.commit({name: text for name, text in texts.items() if name not in todo}, voice_name)
+    return failed
 
 
 def main():
-    for locale in os.listdir(TRANSLATIONS_DIR):
-        if not os.path.isdir(os.path.join(TRANSLATIONS_DIR, locale)):
-            continue
-        voice_dir = os.path.join(TRANSLATIONS_DIR, locale, "voice")
-        raw_messages = get_all_raw_messages(locale)
-        catalog, voice_name = next(raw_messages)
-        for message in get_all_potential_messages(raw_messages, num=range(20), title=get_all_titles(catalog)):
-            if create_cache_file(voice_name, message, voice_dir):
-                print("Generated", message)
-            else:
-                print("Reused", message)
+    parser = argparse.ArgumentParser(description="Records the voice files of all translations.")
+    parser.add_argument("locales", nargs="*", help="locales to record, all by default")
+    parser.add_argument("--backend", choices=["polly", "silence", "command"], default="polly")
+    parser.add_argument("--command", help="TTS command line for the command backend, e.g. "
+                                          "\"sh -c 'espeak-ng -v {voice} --stdout | lame - -'\", which gets the text on stdin")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="parallel synthesis requests")
+    parser.add_argument("--retries", type=int, default=3, help="retries per text with exponential backoff")
+    parser.add_argument("--force", action="store_true", help="record all texts again")
+    parser.add_argument("--prune", action="store_true", help="delete recordings which are no longer used")
+    args = parser.parse_args()
+    if args.backend == "polly":
+        backend = PollyBackend()
+    elif args.backend == "silence":
+        backend = SilenceBackend()
+    else:
+        if not args.command:
+            parser.error("the command backend needs --command")
+        backend = CommandBackend(args.command)
+    locales = args.locales or [locale for locale in sorted(os.listdir(TRANSLATIONS_DIR))
+                               if os.path.isdir(os.path.join(TRANSLATIONS_DIR, locale))]
+    failed = []
+    for locale in locales:
+        failed += rebuild_locale(locale, backend, args.jobs, args.retries, args.force, args.prune)
+    if failed:
+        sys.exit("%i texts could not be recorded, run again to resume." % len(failed))
 
 
 if __name__ == '__main__':
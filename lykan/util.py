@@ -1,13 +1,11 @@
 import collections
+import functools
 import hashlib
-from multiprocessing.dummy.connection import Queue, Connection
+import random
 
 
-def toposort(players):
-    cards = []
-    for player in players:
-        if player.is_alive:
-            cards.append(player.role_card)
+def toposort(cards):
+    cards = list(cards)
     tags = collections.defaultdict(list)
     for card in cards:
         for tag in card.TAGS:
@@ -24,12 +22,13 @@ def toposort(players):
         ordered = set(item for item, dep in deps.items() if not dep)
         if not ordered:
             break
-        yield ordered
+        yield [card for card in cards if card in ordered]  # In seating order, sets would differ between runs.
         deps = {item: (dep - ordered) for item, dep in deps.items() if item not in ordered}
     if deps:
         raise Exception("Circular dependency (%r)" % (deps,))
 
 
+@functools.lru_cache(maxsize=4096)
 def gen_hash(text):
     md = hashlib.md5()
     md.update(text.encode("utf-8"))
@@ -39,10 +38,32 @@ def gen_hash(text):
 def check_vote(amongst, poll_result):
     cnt = collections.Counter(poll_result.values())
     common = cnt.most_common(2)
+    if not common:
+        return None
     if len(common) < 2 or common[0][1] >= len(amongst) / 2:
         return common[0][0]
 
 
-def Pipe(buffer_size=4):
-    a, b = Queue(buffer_size), Queue(buffer_size)
-    return Connection(a, b), Connection(b, a)
+# Keys of the websocket frames in the compact encoding, see main.CompactEncoder.
+COMPACT_KEYS = {"ask": "a", "content": "c", "temporary": "t", "players": "p", "joined": "j", "amongst": "m",
+                "vote": "v", "prompt": "q", "hash": "h", "prefetch": "f", "dont_vibrate": "d", "seq": "s",
+                "acked": "k", "batch": "b", "player": "u", "card_title": "ct", "available": "av"}
+
+
+CODE_LETTERS = "ABCDEFGHJKMNPQRSTUVWXYZ"
+
+
+_code_rng = random.SystemRandom()
+
+
+def gen_game_code(shard=0, shards=1):
+    """Returns a random game code whose first letter tells which of `shards` workers hosts it.
+
+    Codes grant access to games, so they come from the system RNG and not from a seeded one."""
+    first = _code_rng.choice(CODE_LETTERS[shard::shards])
+    return first + "".join(_code_rng.choice(CODE_LETTERS) for i in range(4))
+
+
+def shard_of(code, shards):
+    code = code.strip().upper()
+    return CODE_LETTERS.index(code[0]) % shards if code[:1] and code[0] in CODE_LETTERS else 0
@@ -0,0 +1,127 @@
+import collections
+import hashlib
+import itertools
+import os
+import re
+
+from babel.messages.pofile import read_po
+
+from lykan import cards, util, gameengine
+
+
+# Bit rates in kbit/s by (is MPEG-1, layer) and sample rates by version bits of the frame header.
+_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def mp3_duration(data):
+    """Computes the play time of an MP3 file in seconds by walking its frame headers."""
+    pos = 0
+    if data[:3] == b"ID3":
+        pos = 10 + ((data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | data[9] & 0x7f)
+    duration = 0.0
+    while pos + 4 <= len(data):
+        b1, b2 = data[pos + 1], data[pos + 2]
+        version, layer = (b1 >> 3) & 3, 4 - ((b1 >> 1) & 3)
+        bitrate_index, rate_index, padding = b2 >> 4, (b2 >> 2) & 3, (b2 >> 1) & 1
+        if data[pos] != 0xff or b1 & 0xe0 != 0xe0 or version == 1 or layer == 4 or \
+                bitrate_index in (0, 15) or rate_index == 3:
+            pos += 1  # No frame header, resynchronize.
+            continue
+        bitrate = _BITRATES[version == 3, layer][bitrate_index] * 1000
+        sample_rate = _SAMPLE_RATES[version][rate_index]
+        if layer == 1:
+            samples = 384
+            pos += (12 * bitrate // sample_rate + padding) * 4
+        else:
+            samples = 1152 if layer == 2 or version == 3 else 576
+            pos += samples // 8 * bitrate // sample_rate + padding
+        duration += samples / sample_rate
+    return duration
+
+
+VoiceFile = collections.namedtuple("VoiceFile", "data etag duration")
+
+
+def load_directory(directory):
+    """Reads all voice files of `directory` into memory, keyed by their hash."""
+    files = {}
+    if not os.path.isdir(directory):
+        return files
+    for fname in os.listdir(directory):
+        if fname.endswith(".mp3"):
+            with open(os.path.join(directory, fname), "rb") as f:
+                data = f.read()
+            files[fname[:-len(".mp3")]] = VoiceFile(data, hashlib.md5(data).hexdigest(), mp3_duration(data))
+    return files
+
+
+class VoiceStore:
+    """Serves the voice files of all locales from memory and counts the lookups."""
+
+    def __init__(self, directories):
+        self.files = {locale: load_directory(directory) for locale, directory in directories.items()}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, locale, name):
+        voice_file = self.files[locale].get(name)
+        if voice_file is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return voice_file
+
+    def has(self, locale, name):
+        return name in self.files[locale]
+
+    def duration(self, locale, name):
+        voice_file = self.files[locale].get(name)
+        return voice_file.duration if voice_file else None
+
+    def missing(self, locale, messages):
+        return [message for message in messages if util.gen_hash(message) not in self.files[locale]]
+
+
+def get_all_raw_messages(translations_dir, locale):
+    transfilename = os.path.join(translations_dir, locale, "LC_MESSAGES", "messages.po")
+    with open(transfilename, "r") as f:
+        catalog = read_po(f)
+    voice_name = None
+    for message in catalog:
+        if "<Voice>" in message.id:
+            voice_name = (message.string or message.id).split("<Voice>", 1)[1].split("</", 1)[0]
+    yield (catalog, voice_name) if voice_name else (None, "Unknown")
+    for message in catalog:
+        txt = message.string or message.id
+        if "python-format" in message.flags and "%(" not in txt or message.fuzzy or "<" in txt or \
+                any(fname.endswith("j2") for fname, _ in message.locations):
+            continue
+        yield txt
+
+
+def get_all_titles(catalog):
+    return {catalog[c.TITLE].string or catalog[c.TITLE].id for c in cards.ALL_CARDS + gameengine.Subgroup.__subclasses__() if hasattr(c, "TITLE")}
+
+
+def get_all_potential_messages(messages_iter, **kwargs):
+    for message in messages_iter:
+        groupnames = list(dict.fromkeys(re.findall(r"%\((\w+)\)", message)))
+        if any(groupname not in kwargs for groupname in groupnames):
+            continue  # Not narrated, e.g. progress messages.
+        for values in itertools.product(*[kwargs[groupname] for groupname in groupnames]):
+            yield message % dict(zip(groupnames, values))
+
+
+def get_all_voice_messages(translations_dir, locale):
+    """Returns the voice name and all texts which should have a recording in `locale`."""
+    raw_messages = get_all_raw_messages(translations_dir, locale)
+    catalog, voice_name = next(raw_messages)
+    return voice_name, list(get_all_potential_messages(raw_messages, num=range(20), title=get_all_titles(catalog)))
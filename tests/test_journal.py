@@ -0,0 +1,126 @@
+import random
+import tempfile
+import unittest
+
+from lykan import gameengine, journal
+from lykan.journal import GameJournal
+from lykan.main import Progress, ScheduledGame, activate_locale, app, scheduler
+from lykan.simulator import RandomBot
+from lykan import cards  # Needs the _ which lykan.main installs.
+
+MIXES = [{"Werewolve": 2, "Seer": 1, "Witch": 1, "Citizen": 4},
+         {"Werewolve": 2, "Cupid": 1, "Hunter": 1, "Prince": 1, "Lynchee": 1, "Citizen": 2}]
+# Replies after which the server is killed, around the snapshots of the journal.
+CUTS = [1, 10, journal.SNAPSHOT_INTERVAL - 1, journal.SNAPSHOT_INTERVAL, journal.SNAPSHOT_INTERVAL + 1,
+        2 * journal.SNAPSHOT_INTERVAL + 5]
+
+
+def run_posted():
+    """Runs what the games posted to the scheduler, which is not started in the tests."""
+    while not scheduler.events.empty():
+        func, args = scheduler.events.get_nowait()
+        func(*args)
+
+
+def describe(req):
+    names = lambda players: [player.name for player in players or []]
+    return (type(req).__name__, req.player.name if req.player else None, getattr(req, "msg", None),
+            getattr(req, "prompt", None), names(getattr(req, "players", None)), names(getattr(req, "amongst", None)))
+
+
+def pending(game):
+    """Describes the requests the master screen and the players have to answer before the game goes on."""
+    return sorted((target.name if target is not game else "master", describe(target.last_req))
+                  for target in [game] + game.players if target.last_req is not None
+                  and not isinstance(target.last_req, Progress))
+
+
+class JournalTest(unittest.TestCase):
+    """Kills seeded games after a number of replies and checks that they resume where they were."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = dict(app.config)
+        app.config.update(JOURNAL_DIR=self.directory.name, VOTE_TIMEOUT=None, VOTE_DEFAULT="random")
+        self.context = app.app_context()
+        self.context.push()
+        activate_locale("en")
+
+    def tearDown(self):
+        self.context.pop()
+        app.config.clear()
+        app.config.update(self.config)
+        app.games.clear()
+        self.directory.cleanup()
+
+    def play(self, mix, seed, cut):
+        """Plays a game with bots until `cut` replies are journalled, returns the game or None if it ended before."""
+        code = "G%i" % seed
+        game = app.games[code] = ScheduledGame("en", code, seed)
+        for i in range(sum(mix.values())):
+            game.add_player("Player %i" % i)
+        game.prepare(getattr(cards, card_name) for card_name, count in mix.items() for i in range(count))
+        game.begin()
+        run_posted()
+        bot = RandomBot(random.Random("bot-%i" % seed))
+        for step in range(10000):
+            if game.ended:
+                return None
+            if len(game.journal.replies) >= cut:
+                return game
+            vote = None
+            for target in [game] + game.players:
+                req = target.last_req
+                if req is None or isinstance(req, Progress):
+                    continue
+                if isinstance(req, gameengine.EverybodySelect1Player):
+                    if target.seat % 3 == 0:  # Never votes, the default vote is drawn when the vote ends.
+                        vote = req
+                        continue
+                    reply = bot.choose(game, target, req.amongst or game.players_alive, 1)
+                elif isinstance(req, gameengine.SelectNPlayers):
+                    reply = bot.choose(game, target, req.amongst or game.players_alive, req.n)
+                elif isinstance(req, gameengine.YesNoQuestion):
+                    reply = bot.rng.random() < 0.5
+                else:
+                    reply = " "
+                game._post(game._on_reply, target, req, reply)
+                run_posted()
+            if vote is not None:
+                game._post(game._end_vote, vote)
+                run_posted()
+        self.fail("Game %s did not end" % code)
+
+    def test_resume(self):
+        resumed = 0
+        for mix in MIXES:
+            for seed in range(4):
+                for cut in CUTS:
+                    game = self.play(mix, seed, cut)
+                    if game is None:
+                        continue
+                    game.journal.journal.close()
+                    with open(game.journal.journal_path, "a") as f:
+                        f.write('{"player": "Play')  # Torn by the crash.
+                    del app.games[game.code]
+                    restored = ScheduledGame.restore(GameJournal.resume(self.directory.name, game.code))
+                    app.games[game.code] = restored
+                    run_posted()
+                    with self.subTest(mix=mix, seed=seed, cut=cut):
+                        self.assertEqual(restored.card_names, game.card_names)
+                        self.assertEqual([type(player.role_card).__name__ for player in restored.players],
+                                         [type(player.role_card).__name__ for player in game.players])
+                        self.assertEqual([player.name for player in restored.players_alive],
+                                         [player.name for player in game.players_alive])
+                        self.assertEqual(pending(restored), pending(game))
+                        # The default votes are replayed from the journal, not drawn again.
+                        self.assertEqual(restored.vote_rng.getstate(), random.Random("%s-votes" % seed).getstate())
+                        self.assertEqual(restored.rng.getstate(), game.rng.getstate())
+                    restored.journal.close()
+                    del app.games[game.code]
+                    resumed += 1
+        self.assertGreater(resumed, len(MIXES) * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()